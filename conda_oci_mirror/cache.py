@@ -0,0 +1,198 @@
+# On disk caches shared between runs and worker processes
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+
+import conda_oci_mirror.util as util
+from conda_oci_mirror.logger import logger
+
+
+class DiskCache:
+    """
+    A directory of entries with least recently used eviction.
+
+    Each entry is a file named by the hash of its key, written atomically,
+    so the cache can be shared by pool workers. Reading an entry touches it,
+    and when the cache grows past max_bytes the least recently used entries
+    are removed.
+    """
+
+    # How many writes (per process) between checks of the cache size
+    evict_every = 500
+
+    def __init__(self, root, max_bytes):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.writes = 0
+        util.mkdir_p(self.root)
+
+    def path(self, key):
+        """
+        Get the path for a key, nested by the first characters of its hash.
+        """
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, digest[:2], f"{digest}.json")
+
+    def load(self, key):
+        """
+        Load an entry, or None if we don't have it (or it is corrupt).
+        """
+        path = self.path(key)
+        try:
+            with open(path) as fd:
+                entry = json.load(fd)
+        except (OSError, ValueError):
+            return
+
+        # The entry can be evicted (by another process) since we read it
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def save(self, key, entry):
+        """
+        Save an entry, replacing any previous one.
+        """
+        path = self.path(key)
+        util.mkdir_p(os.path.dirname(path))
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as fd:
+            json.dump(entry, fd)
+        os.replace(tmp, path)
+
+        self.writes += 1
+        if self.writes % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until we are under max_bytes.
+        """
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                # Leave entries that are still being written
+                if filename.endswith(".tmp"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        logger.debug(f"Evicted entries from {self.root}, {total} bytes remain")
+
+
+class ManifestCache(DiskCache):
+    """
+    Manifests keyed by repository and reference (tag or digest).
+
+    Each entry holds the manifest, its digest and ETag (to revalidate with
+    a conditional request) and when it was last checked with the registry.
+    """
+
+    def get(self, uri):
+        return self.load(uri)
+
+    def set(self, uri, manifest, digest=None, etag=None):
+        entry = {
+            "manifest": manifest,
+            "digest": digest,
+            "etag": etag,
+            "checked": time.time(),
+        }
+        self.save(uri, entry)
+        return entry
+
+
+class TagSnapshots(DiskCache):
+    """
+    Tags we know for each repository, to refresh incrementally.
+
+    The cursor is the last tag the registry listed (in registry order), and
+    listed is when we last did a full listing.
+    """
+
+    def get(self, repository):
+        return self.load(repository)
+
+    def set(self, repository, tags, cursor, listed=None):
+        entry = {
+            "tags": tags,
+            "cursor": cursor,
+            "listed": listed or time.time(),
+        }
+        self.save(repository, entry)
+        return entry
+
+    def add(self, repository, tag):
+        """
+        Add a tag we pushed to a snapshot, if we have one.
+        """
+        entry = self.get(repository)
+        if entry and tag not in entry["tags"]:
+            entry["tags"].append(tag)
+            self.save(repository, entry)
+
+
+class MetadataCache(DiskCache):
+    """
+    Package info metadata keyed by the sha256 of the package archive.
+
+    An archive with the same sha256 always has the same info, so pushing it
+    again (e.g., to another registry) writes the cached info.tar.gz and
+    index.json instead of reading the archive. Each entry also has the
+    digest and size of both files, so they aren't hashed again.
+    """
+
+    def get(self, sha256):
+        """
+        Get the entry for an archive, with the content of the files as bytes.
+        """
+        entry = self.load(sha256)
+        if not entry:
+            return
+        try:
+            for layer in entry["layers"].values():
+                layer["content"] = base64.b64decode(layer["content"])
+        except (KeyError, TypeError, ValueError):
+            return
+        return entry
+
+    def set(self, sha256, files):
+        """
+        Save the files (name -> bytes) derived from an archive.
+        """
+        entry = {"layers": {}, "created": time.time()}
+        for name, content in files.items():
+            entry["layers"][name] = {
+                "digest": f"sha256:{hashlib.sha256(content).hexdigest()}",
+                "size": len(content),
+                "content": base64.b64encode(content).decode("ascii"),
+            }
+        self.save(sha256, entry)
+
+        # Give back the content as it was given
+        for name, content in files.items():
+            entry["layers"][name]["content"] = content
+        return entry
@@ -46,6 +46,17 @@ def add_options(options):
 
 @main.command()
 @add_options(options)
+@click.option(
+    "--shallow/--deep",
+    default=False,
+    help="Compare with the last pushed repodata (shallow) or all tags (deep)",
+)
+@click.option(
+    "--changed-only",
+    is_flag=True,
+    default=False,
+    help="Only look at packages added to the channel since the last mirror",
+)
 def mirror(
     channel,
     subdir,
@@ -57,6 +68,8 @@ def mirror(
     debug,
     workers,
     timeout,
+    shallow,
+    changed_only,
 ):
     setup_logger(
         quiet=quiet,
@@ -71,7 +84,7 @@ def mirror(
         workers=workers,
         timeout=timeout,
     )
-    m.update(dry_run)
+    m.update(dry_run, shallow=shallow, changed_only=changed_only)
 
 
 @main.command()
@@ -7,9 +7,65 @@ package_tarbz2_media_type = "application/vnd.conda.package.v1"
 package_conda_media_type = "application/vnd.conda.package.v2"
 repodata_media_type_v1 = "application/vnd.conda.repodata.v1+json"
 repodata_media_type_v1_zst = "application/vnd.conda.repodata.v1+json+zst"
+repodata_media_type_v1_bz2 = "application/vnd.conda.repodata.v1+json+bz2"
+repodata_media_type_v1_gz = "application/vnd.conda.repodata.v1+json+gzip"
 
 CACHE_DIR = pathlib.Path(os.path.dirname(os.path.abspath(__file__))) / "cache"
 
+# Manifests for tags that are moved are always revalidated with the registry
+# Other tags are revalidated when the cached manifest is older than the max age
+mutable_tags = ["latest"]
+manifest_cache_max_age = 24 * 60 * 60
+manifest_cache_max_bytes = 256 * 1024 * 1024
+
+# Tag snapshots are refreshed with only the tags after a cursor, which misses
+# tags others push that sort before it (and tags deleted). A full listing
+# reconciles the snapshot when it is older than the max age
+tag_snapshot_page_size = 1000
+tag_snapshot_max_age = 24 * 60 * 60
+tag_snapshot_max_bytes = 1024 * 1024 * 1024
+
+# Package info metadata (info.tar.gz and index.json) by archive sha256
+metadata_cache_max_bytes = 1024 * 1024 * 1024
+
+# Packages are pushed through a pipeline of stages (download, prepare info
+# metadata, push) with their own workers, joined by queues of this size.
+# Metadata is prepared by processes (default one per cpu, but no more than
+# the mirror workers), and downloads and pushes by threads (default the
+# mirror workers)
+pipeline_queue_size = 16
+pipeline_metadata_workers = None
+
+# Downloaded packages waiting to be pushed are capped at this many bytes
+pipeline_max_staged_bytes = 4 * 1024 * 1024 * 1024
+
+# Read only registry requests (tags, manifests) to have in flight at once
+registry_concurrency = 64
+
+# Registry tokens are refreshed this many seconds before they expire
+# and fetched for the repositories of this many queued tasks ahead
+token_expiry_margin = 10
+token_prefetch_window = 50
+
+# Blobs larger than the threshold are uploaded in (resumable) chunks
+# Not all registries support chunked uploads, so it is off (None) unless set
+chunked_upload_threshold = None
+chunked_upload_size = 16 * 1024 * 1024
+chunked_upload_attempts = 5
+
+# Compressed repodata variants to try (in order) before plain json
+repodata_compression = [".zst", ".bz2"]
+
+# Update cached repodata incrementally with patches (JLAP) when we can
+repodata_jlap = True
+
+# Repodata we push is compressed with zstd (threads -1 is one per cpu)
+# and optionally to other layers for older clients (e.g., ["bz2", "gz"])
+repodata_zstd_level = 15
+repodata_zstd_threads = -1
+repodata_compress_variants = []
+repodata_compress_level = 9
+
 # Default subdirectories in a conda package
 DEFAULT_SUBDIRS = [
     "linux-64",
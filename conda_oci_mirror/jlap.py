@@ -0,0 +1,320 @@
+# Incremental repodata updates with JLAP (json lines of patches)
+
+import copy
+import hashlib
+import json
+
+from conda_oci_mirror.records import JsonStream, ObjectWriter, iter_records
+
+# Digest size for both the line checksum chain and the repodata hash
+digest_size = 32
+
+
+class JlapError(ValueError):
+    """
+    A JLAP file (or the patches it holds) cannot be used.
+    """
+
+
+def keyed_hash(data, key):
+    """
+    Hash a line keyed with the previous hash in the checksum chain.
+    """
+    return hashlib.blake2b(data, key=key, digest_size=digest_size).digest()
+
+
+def repodata_hasher():
+    """
+    Get a hasher for the (uncompressed) repodata, as it is named in patches.
+    """
+    return hashlib.blake2b(digest_size=digest_size)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    Get the repodata hash of a file.
+    """
+    hasher = repodata_hasher()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def parse(content, iv=None):
+    """
+    Parse and verify JLAP content, starting at a line with a known hash (iv).
+
+    Without an iv, the content is the whole file and the first line is the
+    iv. The last line is the checksum of every line before it, each hashed
+    keyed by the hash of the line before. We return the patches, the
+    metadata (second to last) line, and the position (in the content) and
+    iv to fetch from next time. The metadata and checksum lines are
+    rewritten when the server adds patches, so we start from the metadata.
+    """
+    lines = content.split(b"\n")
+
+    # A trailing newline leaves an empty line
+    if lines and not lines[-1]:
+        lines = lines[:-1]
+
+    pos = 0
+    if iv is None:
+        if not lines:
+            raise JlapError("JLAP content is empty")
+        first = lines.pop(0)
+        try:
+            iv = bytes.fromhex(first.decode("utf-8"))
+        except ValueError:
+            raise JlapError("JLAP content does not start with an iv")
+        pos += len(first) + 1
+
+    if len(lines) < 2:
+        raise JlapError("JLAP content is missing metadata and checksum lines")
+    *lines, checksum = lines
+
+    # The position and iv of the metadata line
+    for line in lines[:-1]:
+        iv = keyed_hash(line, iv)
+        pos += len(line) + 1
+    next_iv = iv
+    iv = keyed_hash(lines[-1], iv)
+
+    if iv.hex() != checksum.decode("utf-8", errors="replace").strip():
+        raise JlapError("JLAP checksum does not match")
+
+    try:
+        patches = [json.loads(line) for line in lines[:-1]]
+        metadata = json.loads(lines[-1])
+    except ValueError as e:
+        raise JlapError(f"JLAP line is not valid json: {e}")
+    return patches, metadata, pos, next_iv
+
+
+def find_patches(patches, have, want):
+    """
+    Find the patches to go from the repodata hash we have to the one we want.
+    """
+    by_target = {p["to"]: p for p in patches if "to" in p and "from" in p}
+    chain = []
+    while want != have:
+        patch = by_target.get(want)
+        if not patch:
+            raise JlapError(f"No patches lead from {have} to {want}")
+        chain.append(patch)
+        want = patch["from"]
+    return list(reversed(chain))
+
+
+def split_pointer(pointer):
+    """
+    Split a json pointer into its (unescaped) parts.
+    """
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise JlapError(f"Invalid json pointer {pointer}")
+    return [p.replace("~1", "/").replace("~0", "~") for p in pointer[1:].split("/")]
+
+
+def resolve(document, parts):
+    """
+    Get the parent container of a json pointer and the last part.
+    """
+    for part in parts[:-1]:
+        if isinstance(document, list):
+            part = int(part)
+        document = document[part]
+    return document, parts[-1]
+
+
+def get_value(document, pointer):
+    parts = split_pointer(pointer)
+    if not parts:
+        return document
+    parent, key = resolve(document, parts)
+    return parent[int(key) if isinstance(parent, list) else key]
+
+
+def remove_value(document, pointer):
+    parent, key = resolve(document, split_pointer(pointer))
+    if isinstance(parent, list):
+        return parent.pop(int(key))
+    return parent.pop(key)
+
+
+def add_value(document, pointer, value):
+    parts = split_pointer(pointer)
+    if not parts:
+        return value
+    parent, key = resolve(document, parts)
+    if isinstance(parent, list):
+        if key == "-":
+            parent.append(value)
+        else:
+            parent.insert(int(key), value)
+    else:
+        parent[key] = value
+    return document
+
+
+def apply_patch(document, operations):
+    """
+    Apply a json patch (RFC 6902) to a document, changing it in place.
+
+    The (possibly replaced) document is returned.
+    """
+    for op in operations:
+        try:
+            kind = op["op"]
+            path = op["path"]
+            if kind == "add":
+                document = add_value(document, path, op["value"])
+            elif kind == "remove":
+                remove_value(document, path)
+            elif kind == "replace":
+                if split_pointer(path):
+                    remove_value(document, path)
+                document = add_value(document, path, op["value"])
+            elif kind == "move":
+                value = remove_value(document, op["from"])
+                document = add_value(document, path, value)
+            elif kind == "copy":
+                value = copy.deepcopy(get_value(document, op["from"]))
+                document = add_value(document, path, value)
+            elif kind == "test":
+                if get_value(document, path) != op["value"]:
+                    raise JlapError(f"Patch test failed for {path}")
+            else:
+                raise JlapError(f"Unknown patch operation {kind}")
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            if isinstance(e, JlapError):
+                raise
+            raise JlapError(f"Cannot apply patch operation {op}: {e}")
+    return document
+
+
+def group_operations(patches, package_types):
+    """
+    Group patch operations by the package record or top level key they change.
+
+    Operations on a package record are keyed by (package type, filename), and
+    others by (top level key, None). Operations that span groups (e.g., a move
+    between records) or replace a whole package type can't be streamed.
+    """
+    groups = {}
+    for patch in patches:
+        for op in patch["patch"]:
+            keys = set()
+            for pointer in [op.get("path"), op.get("from")]:
+                if pointer is None:
+                    continue
+                parts = split_pointer(pointer)
+                if not parts or (len(parts) == 1 and parts[0] in package_types):
+                    raise JlapError(f"Cannot stream patch operation {op}")
+                keys.add((parts[0], parts[1] if parts[0] in package_types else None))
+            if len(keys) != 1:
+                raise JlapError(f"Cannot stream patch operation {op}")
+            groups.setdefault(keys.pop(), []).append(op)
+    return groups
+
+
+def patch_repodata(source, dest, patches, package_types=None):
+    """
+    Apply patches to repodata as it streams from source to dest.
+
+    Records are decoded one at a time and only those that the patches change
+    are patched, so we never hold the whole document. Records the patches
+    add go at the end of their package type.
+    """
+    package_types = package_types or ["packages", "packages.conda"]
+    groups = group_operations(patches, package_types)
+
+    def patched(key, filename, value):
+        """
+        Apply the operations for a record (or top level key) to its value.
+
+        We return the items to write in its place, if any.
+        """
+        operations = groups.pop((key, filename), [])
+        if filename is None:
+            return apply_patch({} if value is None else {key: value}, operations)
+        document = {key: {} if value is None else {filename: value}}
+        return apply_patch(document, operations).get(key, {})
+
+    def added(key):
+        """
+        Get records the patches add to a package type.
+        """
+        records = {}
+        for filename in [name for k, name in list(groups) if k == key]:
+            records.update(patched(key, filename, None))
+        return records
+
+    with open(source, encoding="utf-8") as fd, open(dest, "w") as out:
+        stream = JsonStream(fd)
+        stream.expect("{")
+        writer = ObjectWriter(out)
+        seen = set()
+        done = stream.peek() == "}"
+        while not done:
+            key = stream.decode()
+            stream.expect(":")
+            seen.add(key)
+            if key in package_types:
+                writer.write_key(key)
+                records = ObjectWriter(out)
+                for filename, info in iter_records(stream):
+                    if (key, filename) in groups:
+                        for item in patched(key, filename, info).items():
+                            records.write(*item)
+                    else:
+                        records.write(filename, info)
+                for item in added(key).items():
+                    records.write(*item)
+                records.close()
+            else:
+                for item in patched(key, None, stream.decode()).items():
+                    writer.write(*item)
+            done = stream.expect(",}") == "}"
+
+        # The patches can also add top level keys
+        for key in sorted(set(k for k, _ in groups) - seen):
+            if key in package_types:
+                writer.write(key, added(key))
+            else:
+                for item in patched(key, None, None).items():
+                    writer.write(*item)
+        writer.close()
+
+
+def changed_filenames(patches, package_types=None):
+    """
+    Get the package filenames added and removed by a series of patches.
+
+    A record that is replaced as a whole counts as added. Changes inside a
+    record (e.g., hotfixed dependencies) don't change the archive.
+    """
+    package_types = package_types or ["packages", "packages.conda"]
+    added = set()
+    removed = set()
+    for patch in patches:
+        for op in patch["patch"]:
+            parts = split_pointer(op.get("path", ""))
+            if len(parts) != 2 or parts[0] not in package_types:
+                continue
+            filename = parts[1]
+            if op["op"] in ["add", "replace", "copy", "move"]:
+                added.add(filename)
+                removed.discard(filename)
+            elif op["op"] == "remove":
+                removed.add(filename)
+                added.discard(filename)
+
+            # The source of a move is removed
+            if op["op"] == "move":
+                source = split_pointer(op["from"])
+                if len(source) == 2 and source[0] in package_types:
+                    removed.add(source[1])
+                    added.discard(source[1])
+    return added, removed
@@ -4,12 +4,12 @@ import pathlib
 import shutil
 import subprocess
 
-import requests
-
 import conda_oci_mirror.decorators as decorators
 import conda_oci_mirror.defaults as defaults
 import conda_oci_mirror.package as pkg
 import conda_oci_mirror.repo as repository
+import conda_oci_mirror.sessions as sessions
+import conda_oci_mirror.state as sync_state
 import conda_oci_mirror.tasks as tasks
 import conda_oci_mirror.util as util
 from conda_oci_mirror.logger import logger
@@ -20,7 +20,7 @@ def get_forbidden_packages():
     """
     Get listing of undistributable packages from conda.
     """
-    response = requests.get(defaults.forbidden_package_url)
+    response = sessions.get_session().get(defaults.forbidden_package_url)
     if response.status_code != 200:
         raise ValueError(
             f"Cannot retrieve forbidden packages from {defaults.forbidden_package_url}"
@@ -78,14 +78,21 @@ class Mirror:
         if "://" in self.registry:
             self.registry = self.registry.split("://")[1]
 
+        # Registry metadata (e.g., manifests) is cached alongside packages
+        # and so are package info metadata and the state of what we mirrored
+        oras.set_cache_dir(self.cache_dir)
+        pkg.set_cache_dir(self.cache_dir)
+        self.state = sync_state.SyncState(os.path.join(self.cache_dir, "state.db"))
+
+        # Set the number of workers, and size connection pools to match
+        self.workers = workers
+        sessions.set_pool_size(workers)
+
         # Set listing of (undistributable) packages to skip
         self.skip_packages = (
             get_forbidden_packages() if channel == "conda-forge" else None
         )
 
-        # Set the number of workers
-        self.workers = workers
-
         # Set the timeout
         self.timeout = timeout / 1000.0
 
@@ -99,14 +106,31 @@ class Mirror:
         util.print_item("  Packages:", "all" if not self.packages else self.packages)
 
     @decorators.require_registry
-    def update(self, dry_run=False, serial=False, include_yanked=True):
+    def update(
+        self,
+        dry_run=False,
+        serial=False,
+        include_yanked=True,
+        shallow=False,
+        changed_only=False,
+    ):
         """
         Update from a conda mirror (do a mirror) akin to a pull and a push.
+
+        A shallow update only looks for packages missing from the repodata
+        we last pushed, while a deep update checks the tags of every package.
+        With changed_only, we only look at packages added since the last
+        update, for subdirs whose repodata we could update incrementally.
         """
         util.print_item("To: ", self.registry)
 
-        # Create a task runner (defaults to 4 processes)
-        runner = tasks.TaskRunner(workers=self.workers)
+        # Packages are pushed through a pipeline as they are found
+        # (with workers for each stage, defaults to 4), unless serial
+        runner = (
+            tasks.TaskRunner(workers=self.workers)
+            if serial
+            else tasks.PipelineRunner(workers=self.workers)
+        )
 
         # If they think they are pushing but no auth, they are not :)
         if not oras.has_auth and dry_run is False:
@@ -114,16 +138,27 @@ class Mirror:
                 "ORAS is not authenticated, if you registry requires auth this will not work"
             )
 
+        # Repository metadata is fetched (or revalidated) once per update
+        fetched = {}
         for subdir, cache_dir in self.iter_subdirs():
             repo = repository.PackageRepo(
-                self.channel, subdir, cache_dir, self.registry
+                self.channel,
+                subdir,
+                cache_dir,
+                self.registry,
+                state=self.state,
+                fetched=fetched,
             )
 
             # Run filter based on packages we are looking for, and forbidden
             # This includes packages and packages.conda. If include yanked is true,
             # this means we use repodata_from_packages.json that includes removed.
             for package, info in repo.find_packages(
-                self.packages, self.skip_packages, include_yanked=include_yanked
+                self.packages,
+                self.skip_packages,
+                include_yanked=include_yanked,
+                changed_only=changed_only,
+                shallow=shallow,
             ):
                 # Add the new tasks to be run by the runner
                 # This will get mapped into a Package instance to interact with
@@ -132,7 +167,7 @@ class Mirror:
                 )
                 runner.add_task(
                     tasks.PackageUploadTask(
-                        task, wait_time=self.timeout, dry_run=dry_run
+                        task, wait_time=self.timeout, dry_run=dry_run, state=self.state
                     )
                 )
 
@@ -192,8 +227,12 @@ class Mirror:
             except Exception as e:
                 logger.warning(f"Issue retrieving uri: {uri}: {e}")
 
+            # What we pushed (and its sha256) is in the sync state
+            known = self.state.get_subdir(self.registry, self.channel, subdir)
+
             # Don't repeat requests for same uri and media type
             seen = set()
+            pulls = []
             for package_file, info in repodata.packages:
                 # The package name
                 package = info["name"]
@@ -213,19 +252,49 @@ class Mirror:
                 if (uri, media_type) in seen:
                     continue
 
+                # Skip the registry if we already have the file we pushed
+                ext = repodata.get_package_extension(package_file)
+                filename = f"{package}-{latest}.{ext}"
+                if self.have_pushed_file(known.get(filename), cache_dir):
+                    logger.info(f"{filename} is already in {cache_dir}")
+                    seen.add((uri, media_type))
+                    continue
+
                 # Dry run don't actually do it
                 if dry_run:
                     logger.info(f"Would be pulling {package}, but dry-run is set.")
                     continue
                 seen.add((uri, media_type))
+                pulls.append((uri, media_type))
 
-                # Not every package is guaranteed to exist
+            # Not every package is guaranteed to exist, so get manifests at once
+            # They are cached for the download tasks to use
+            manifests = dict(
+                sessions.iter_concurrent(
+                    oras.get_cached_manifest, set(x[0] for x in pulls)
+                )
+            )
+            for uri, media_type in pulls:
+                if isinstance(manifests[uri], Exception):
+                    logger.warning(f"Cannot pull package {uri}: {manifests[uri]}")
+                    continue
                 runner.add_task(tasks.DownloadTask(uri, cache_dir, media_type))
 
         if serial:
             return runner.run_serial()
         return runner.run()
 
+    def have_pushed_file(self, entry, cache_dir):
+        """
+        Determine if a file we pushed (a sync state entry) is in a cache.
+        """
+        if not entry or not entry["sha256"]:
+            return False
+        path = os.path.join(cache_dir, entry["filename"])
+        if not os.path.exists(path):
+            return False
+        return sync_state.is_mirrored(entry, util.cached_sha256sum(path))
+
     @decorators.require_registry
     def push_all(self, dry_run=False, serial=False):
         """
@@ -252,7 +321,11 @@ class Mirror:
         for subdir, cache_dir in self.iter_subdirs():
             # Create a new task runner per subdir
             # The reason is that we cleanup between them
-            runner = tasks.TaskRunner(workers=self.workers)
+            runner = (
+                tasks.TaskRunner(workers=self.workers)
+                if serial
+                else tasks.PipelineRunner(workers=self.workers)
+            )
 
             # The channel cache is one level up from our subdir cache
             channel_root = os.path.dirname(cache_dir)
@@ -283,6 +356,18 @@ class Mirror:
                     new_packages += [
                         f for f in files if f.name not in repodata.package_archives
                     ]
+
+            # Skip packages the sync state knows we pushed (with the same file)
+            if not push_all:
+                known = self.state.get_subdir(self.registry, self.channel, subdir)
+                new_packages = [
+                    f
+                    for f in new_packages
+                    if f.name not in known
+                    or not sync_state.is_mirrored(
+                        known[f.name], util.cached_sha256sum(str(f))
+                    )
+                ]
             logger.info(f"Found {len(new_packages)} packages")
 
             # Push with an updated timestamp
@@ -301,7 +386,7 @@ class Mirror:
                 )
                 runner.add_task(
                     tasks.PackageUploadTask(
-                        task, wait_time=self.timeout, dry_run=dry_run
+                        task, wait_time=self.timeout, dry_run=dry_run, state=self.state
                     )
                 )
 
@@ -1,13 +1,23 @@
 import datetime
+import hashlib
 import os
+import threading
+import time
+import urllib.parse
 
+import jsonschema
 import oras as oraslib
+import oras.auth
 import oras.defaults
 import oras.oci
 import oras.provider
+import oras.schemas
 from oras.decorator import ensure_container
 
+import conda_oci_mirror.defaults as defaults
+import conda_oci_mirror.sessions as sessions
 import conda_oci_mirror.util as util
+from conda_oci_mirror.cache import ManifestCache, TagSnapshots
 from conda_oci_mirror.logger import logger
 
 
@@ -33,11 +43,15 @@ class Pusher:
     Class to handle layers and pushing with oras
     """
 
-    def __init__(self, root, timestamp=None):
+    def __init__(self, root, timestamp=None, client=None):
         self.root = root
         self.layers = []
+        self.manifest = None
         self.timestamp = timestamp or datetime.datetime.now()
 
+        # The oras client to push with, defaults to the shared one
+        self.client = client
+
     @property
     def created_at(self):
         """
@@ -48,11 +62,14 @@ class Pusher:
             return self.timestamp
         return self.timestamp.strftime("%Y.%m.%d.%H.%M")
 
-    def add_layer(self, path, media_type, title=None, annotations=None):
+    def add_layer(
+        self, path, media_type, title=None, annotations=None, digest=None, size=None
+    ):
         """
         Helper function to add a layer.
 
         If a title is not provided, we assume the same as the relative path.
+        A digest and size we already know save reading the file to push it.
         """
         if not title:
             title = path
@@ -62,6 +79,7 @@ class Pusher:
             path = os.path.join(self.root, path)
         if not os.path.exists(path):
             raise FileExistsError(f"{path} does not exist.")
+        path = os.path.abspath(path)
 
         annotations = annotations or {}
         annotations.update({"creationTime": self.created_at})
@@ -71,6 +89,8 @@ class Pusher:
                 "title": title,
                 "media_type": media_type,
                 "annotations": annotations,
+                "digest": digest,
+                "size": size,
             }
         )
 
@@ -81,35 +101,317 @@ class Pusher:
         # Add some custom annotations!
         logger.debug(f"⭐️ Pushing {uri}: {self.created_at}")
 
-        # The context should be the file root
-        with oraslib.utils.workdir(self.root):
-            oras.push(uri, self.layers)
+        # Layer paths are absolute, so we don't change the working directory
+        # (which is shared by threads pushing at once)
+        result = (self.client or oras).push(uri, self.layers)
+
+        # Keep the manifest so we can add tags without pushing layers again
+        self.manifest = result["manifest"]
+
+        # Return lookup with URI, layers, and bytes we did (or did not) send
+        return {
+            "uri": uri,
+            "layers": self.layers,
+            "digest": result.get("digest"),
+            "bytes_sent": result["bytes_sent"],
+            "bytes_skipped": result["bytes_skipped"],
+        }
+
+    def tag(self, uri):
+        """
+        Add a tag (uri with tag) to the manifest we last pushed.
+
+        This only uploads the manifest, the layers are already in the registry.
+        """
+        if not self.manifest:
+            raise ValueError("A manifest must be pushed before it can be tagged.")
+        logger.debug(f"⭐️ Tagging {uri}: {self.created_at}")
+        (self.client or oras).tag(uri, self.manifest)
+
+        blobs = self.manifest["layers"] + [self.manifest["config"]]
+        return {
+            "uri": uri,
+            "layers": self.layers,
+            "bytes_sent": 0,
+            "bytes_skipped": sum(x["size"] for x in blobs),
+        }
+
+    def push_tags(self, uri, tags):
+        """
+        Push to the first tag, and add the remaining tags to the same manifest.
+
+        uri is the registry name without a tag.
+        """
+        tags = list(tags)
+        pushes = [self.push(f"{uri}:{tags[0]}")]
+        for tag in tags[1:]:
+            pushes.append(self.tag(f"{uri}:{tag}"))
+        return pushes
+
+
+# Cache of blobs known to exist, digest -> set of repositories
+# (shared by clients in threads, so it is changed with the lock)
+blob_cache = {}
+blob_cache_lock = threading.Lock()
+
+
+def add_known_blob(digest, repository):
+    """
+    Remember that a repository has a blob.
+    """
+    with blob_cache_lock:
+        blob_cache.setdefault(digest, set()).add(repository)
+
+
+def get_known_repositories(digest):
+    """
+    Get the repositories we know have a blob.
+    """
+    with blob_cache_lock:
+        return set(blob_cache.get(digest, set()))
 
-        # Return lookup with URI and layers
-        return {"uri": uri, "layers": self.layers}
 
+def get_repository(container):
+    """
+    Get the repository name (registry and namespace, without tag) for a container.
+    """
+    return f"{container.registry}/{container.api_prefix}"
 
-# Cache of manifests
-manifest_cache = {}
+
+def scope_candidates(scope):
+    """
+    Get scopes with a token that would satisfy a scope.
+
+    A token for pull,push on a repository also works to pull from it.
+    """
+    if not scope:
+        return [scope]
+    candidates = [scope]
+    if scope.endswith(":pull"):
+        candidates += [f"{scope},push", f"{scope[: -len('pull')]}push,pull"]
+    return candidates
 
 
 class Registry(oras.provider.Registry):
+    # Set with set_cache_dir to cache manifests and tags on disk
+    manifest_cache = None
+    tag_snapshots = None
+
+    def __init__(self, *args, **kwargs):
+        # Headers are kept per thread, so concurrent requests don't share a token
+        self._local = threading.local()
+
+        # A client can have its own session, otherwise it uses the pooled one
+        self._own_session = None
+        super().__init__(*args, **kwargs)
+
+        # Bearer tokens by (realm, service, scope), shared with workers by the TaskRunner
+        self.tokens = {}
+
+        # The realm and service a registry hostname asks us to authenticate with
+        self.auth_challenges = {}
+
+    @property
+    def headers(self):
+        """
+        Get the headers (e.g., Authorization) for the current thread.
+
+        A new thread starts with our basic auth (if we have it), as if
+        set_basic_auth had been called in that thread.
+        """
+        if not hasattr(self._local, "headers"):
+            self._local.headers = {}
+            if getattr(self, "_basic_auth", None):
+                self._local.headers["Authorization"] = f"Basic {self._basic_auth}"
+        return self._local.headers
+
+    @headers.setter
+    def headers(self, headers):
+        self._local.headers = headers
+
+    @property
+    def session(self):
+        """
+        Use our own session, or the pooled session for this process.
+
+        The pooled session is created again after a fork.
+        """
+        return self._own_session or sessions.get_session()
+
+    @session.setter
+    def session(self, session):
+        # Sessions are managed per process by conda_oci_mirror.sessions
+        pass
+
+    def clone(self):
+        """
+        Get a client with the same settings, auth, tokens and caches.
+
+        The clone has its own session, for a thread that pushes at the same
+        time as others.
+        """
+        client = Registry(hostname=self.hostname)
+        client.prefix = self.prefix
+        client._basic_auth = self._basic_auth
+        client.has_auth = getattr(self, "has_auth", False)
+        client.tokens = self.tokens
+        client.auth_challenges = self.auth_challenges
+        client.manifest_cache = self.manifest_cache
+        client.tag_snapshots = self.tag_snapshots
+        client._own_session = sessions.new_session()
+        return client
+
     def set_insecure(self):
         """
         Change the prefix used (http/https) based on user preference.
         """
         self.prefix = "http"
 
+    def set_cache_dir(self, cache_dir):
+        """
+        Keep registry metadata (e.g., manifests) under a cache directory.
+        """
+        self.manifest_cache = ManifestCache(
+            os.path.join(cache_dir, ".oci", "manifests"),
+            max_bytes=defaults.manifest_cache_max_bytes,
+        )
+        self.tag_snapshots = TagSnapshots(
+            os.path.join(cache_dir, ".oci", "tags"),
+            max_bytes=defaults.tag_snapshot_max_bytes,
+        )
+
+    @ensure_container
+    def list_tags(self, container, last=None):
+        """
+        List tags for a repository following pagination, optionally after a cursor.
+        """
+        params = {"n": defaults.tag_snapshot_page_size}
+        if last:
+            params["last"] = last
+        tags_url = oraslib.utils.append_url_params(
+            f"{self.prefix}://{container.registry}/v2/{container.api_prefix}/tags/list",
+            params,
+        )
+        tags = []
+
+        def extract_tags(response):
+            new_tags = response.json().get("tags") or []
+            tags.extend(new_tags)
+            return bool(new_tags)
+
+        self._do_paginated_request(tags_url, callable=extract_tags)
+        return tags
+
+    @ensure_container
+    def get_cached_tags(self, container):
+        """
+        Get all tags for a repository, using (and refreshing) its tag snapshot.
+
+        Between full listings we trust the snapshot, and only ask the registry
+        for tags after the last one it listed (last=<cursor>). Registries list
+        tags in lexical order, so this misses tags pushed by someone else that
+        sort before the cursor, and tags that were deleted. Tags we push are
+        added to the snapshot as we go, and a full listing (when the snapshot
+        is older than defaults.tag_snapshot_max_age, or a registry ignores
+        the cursor and lists it again) reconciles the rest.
+        """
+        snapshots = self.tag_snapshots
+        if not snapshots:
+            return self.list_tags(container)
+
+        repository = get_repository(container)
+        snapshot = snapshots.get(repository)
+        if (
+            snapshot
+            and snapshot["cursor"]
+            and time.time() - snapshot["listed"] < defaults.tag_snapshot_max_age
+        ):
+            try:
+                new_tags = self.list_tags(container, last=snapshot["cursor"])
+            except ValueError as e:
+                logger.debug(f"Cannot list tags of {repository} after cursor: {e}")
+                new_tags = [snapshot["cursor"]]
+
+            if snapshot["cursor"] not in new_tags:
+                known = set(snapshot["tags"])
+                tags = snapshot["tags"] + [x for x in new_tags if x not in known]
+                cursor = new_tags[-1] if new_tags else snapshot["cursor"]
+                return snapshots.set(repository, tags, cursor, snapshot["listed"])[
+                    "tags"
+                ]
+            logger.debug(f"Tag snapshot for {repository} is inconsistent")
+
+        # The full listing raises an error if the repository does not exist
+        tags = self.list_tags(container)
+        if snapshot:
+            known = set(snapshot["tags"])
+            listed = set(tags)
+            logger.debug(
+                f"Reconciled tags of {repository}: {len(listed - known)} missed, "
+                f"{len(known - listed)} deleted"
+            )
+        snapshots.set(repository, tags, tags[-1] if tags else None)
+        return tags
+
+    def add_snapshot_tag(self, container):
+        """
+        Add a tag we pushed to the tag snapshot of its repository
+        """
+        if self.tag_snapshots:
+            self.tag_snapshots.add(get_repository(container), container.tag)
+
+    @ensure_container
+    def get_cached_manifest(self, container):
+        """
+        Get a manifest, using (and revalidating) the manifest cache.
+
+        A digest reference never changes, so we trust the cache. Tags are
+        revalidated with a conditional request (If-None-Match) when they
+        are mutable (e.g., latest) or the entry is older than the max age.
+        """
+        cache = self.manifest_cache
+        if not cache:
+            return self.get_manifest(container)
+
+        entry = cache.get(container.uri)
+        if entry and container.digest:
+            return entry["manifest"]
+        if (
+            entry
+            and container.tag not in defaults.mutable_tags
+            and time.time() - entry["checked"] < defaults.manifest_cache_max_age
+        ):
+            return entry["manifest"]
+
+        reference = container.digest or container.tag
+        url = f"{self.prefix}://{container.registry}/v2/{container.api_prefix}/manifests/{reference}"
+        headers = {"Accept": oraslib.defaults.default_manifest_media_type}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        response = self.do_request(url, "GET", headers=headers)
+
+        # Not modified, the cached manifest is still good
+        if entry and response.status_code == 304:
+            logger.debug(f"Manifest for {container.uri} is not modified")
+            return cache.set(
+                container.uri, entry["manifest"], entry["digest"], entry["etag"]
+            )["manifest"]
+
+        self._check_200_response(response)
+        manifest = response.json()
+        jsonschema.validate(manifest, schema=oraslib.schemas.manifest)
+        digest = response.headers.get("Docker-Content-Digest")
+        etag = response.headers.get("ETag") or (f'"{digest}"' if digest else None)
+        cache.set(container.uri, manifest, digest, etag)
+        return manifest
+
     @ensure_container
     def pull_by_media_type(self, container, dest, media_type=None):
         """
         Given a manifest of layers, retrieve a layer based on desired media type
         """
-        # Keep a cache of manifests
-        global manifest_cache
-        if container.uri not in manifest_cache:
-            manifest_cache[container.uri] = self.get_manifest(container)
-        manifest = manifest_cache[container.uri]
+        # Manifests are cached on disk, and revalidated if needed
+        manifest = self.get_cached_manifest(container)
 
         # Let's return a list of download paths to the user
         paths = []
@@ -128,8 +430,9 @@ class Registry(oras.provider.Registry):
             outfile = oraslib.utils.sanitize_path(dest, os.path.join(dest, artifact))
 
             # If it already exists with the same digest, don't do it :)
+            # The digest is cached next to the file, so we only hash it once
             if os.path.exists(outfile):
-                expected_digest = f"sha256:{util.sha256sum(outfile)}"
+                expected_digest = f"sha256:{util.cached_sha256sum(outfile)}"
                 if layer["digest"] == expected_digest:
                     print(
                         f"{outfile} already exists with expected hash, not re-downloading."
@@ -139,19 +442,243 @@ class Registry(oras.provider.Registry):
 
             # this function  handles creating the output directory if does not exist
             print(f"Downloading {artifact} to {outfile}")
-            path = self.download_blob(container, layer["digest"], outfile)
+            path = self.download_verified_blob(container, layer, outfile)
             paths.append(path)
 
         return paths
 
+    def download_verified_blob(self, container, layer, outfile):
+        """
+        Stream download a blob, hashing it as the bytes arrive.
+
+        We write to a partial file next to the output, and only move it into
+        place when the digest matches. A download that grows past the size
+        in the layer is aborted early.
+        """
+        algorithm, expected = layer["digest"].split(":", 1)
+        hasher = hashlib.new(algorithm)
+        size = 0
+
+        outdir = os.path.dirname(outfile)
+        if outdir:
+            util.mkdir_p(outdir)
+        partial = f"{outfile}.partial"
+        try:
+            with self.get_blob(container, layer["digest"], stream=True) as r:
+                r.raise_for_status()
+                with open(partial, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=1024 * 1024):
+                        size += len(chunk)
+                        if "size" in layer and size > layer["size"]:
+                            raise ValueError(
+                                f"{layer['digest']} is larger than the expected {layer['size']} bytes"
+                            )
+                        hasher.update(chunk)
+                        f.write(chunk)
+
+            if hasher.hexdigest() != expected:
+                raise ValueError(
+                    f"Downloaded {algorithm}:{hasher.hexdigest()}, expected {layer['digest']}"
+                )
+        except Exception:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+        os.replace(partial, outfile)
+        if algorithm == "sha256":
+            util.write_digest_sidecar(outfile, expected)
+        return outfile
+
+    def blob_exists(self, container, digest):
+        """
+        Determine if a repository already has a blob, first checking the cache.
+        """
+        repository = get_repository(container)
+        if repository in get_known_repositories(digest):
+            return True
+
+        self.reset_basic_auth()
+        response = self.get_blob(container, digest, head=True)
+        if response.status_code != 200:
+            return False
+        add_known_blob(digest, repository)
+        return True
+
+    def mount_blob(self, container, digest):
+        """
+        Try to mount a blob we know exists in another repository on the same registry.
+
+        Returns True if the registry mounted it. A registry that refuses the
+        mount starts a regular upload session instead (202), which we cancel.
+        """
+        sources = [
+            x
+            for x in get_known_repositories(digest)
+            if x.startswith(f"{container.registry}/")
+        ]
+        if not sources:
+            return False
+
+        source = sources[0].split("/", 1)[-1]
+        mount_url = oraslib.utils.append_url_params(
+            f"{self.prefix}://{container.upload_blob_url()}",
+            {"mount": digest, "from": source},
+        )
+        response = self.do_request(mount_url, "POST", headers=self.headers)
+        if response.status_code != 201:
+            logger.debug(f"Registry refused to mount {digest} from {source}")
+            session_url = self._get_location(response, container)
+            if response.status_code == 202 and session_url:
+                self.cancel_upload(session_url)
+            return False
+        add_known_blob(digest, get_repository(container))
+        return True
+
+    def ensure_blob(self, blob, container, layer):
+        """
+        Upload a blob unless the repository already has it, or it can be mounted.
+
+        Returns True if the blob was uploaded, and False if it was skipped.
+        """
+        if self.blob_exists(container, layer["digest"]):
+            logger.debug(f"{layer['digest']} already exists in {container.uri}")
+            return False
+
+        if self.mount_blob(container, layer["digest"]):
+            logger.debug(f"Mounted {layer['digest']} into {container.uri}")
+            return False
+
+        # Large blobs are uploaded in chunks we can resume (if enabled)
+        threshold = defaults.chunked_upload_threshold
+        if threshold is not None and layer["size"] > threshold:
+            response = self.resumable_upload(blob, container, layer)
+        else:
+            response = self.upload_blob(blob, container, layer)
+        self._check_200_response(response)
+        add_known_blob(layer["digest"], get_repository(container))
+        return True
+
+    def get_upload_offset(self, session_url, container):
+        """
+        Ask the registry how much of an upload session it has accepted.
+
+        Returns the (possibly updated) session url and the offset to resume from.
+        """
+        response = self.do_request(session_url, "GET", headers=self.headers)
+        if response.status_code not in [200, 204]:
+            self._parse_response_errors(response)
+            raise ValueError(f"Cannot get status of upload {session_url}")
+
+        # The range is inclusive, e.g., 0-1023 means the first 1024 bytes
+        offset = 0
+        accepted = response.headers.get("Range")
+        if accepted:
+            offset = int(accepted.split("-")[-1]) + 1
+        return self._get_location(response, container) or session_url, offset
+
+    def cancel_upload(self, session_url):
+        """
+        Cancel an upload session we won't use, so the registry can clean it up.
+        """
+        try:
+            self.do_request(session_url, "DELETE", headers=self.headers).close()
+        except Exception as e:
+            logger.debug(f"Cannot cancel upload {session_url}: {e}")
+
+    def resumable_upload(self, blob, container, layer):
+        """
+        Upload a blob in chunks (PATCH with Content-Range) and then close it (PUT).
+
+        If a chunk fails, we ask the registry for the offset it has and resume
+        from there instead of sending the entire blob again. Each chunk (and
+        the final PUT) gets its own attempts. Not every registry supports
+        chunked uploads, so if the first chunk fails we cancel the session
+        and upload the blob whole.
+        """
+        self.reset_basic_auth()
+
+        # Start an upload session
+        headers = {"Content-Type": "application/octet-stream", "Content-Length": "0"}
+        upload_url = f"{self.prefix}://{container.upload_blob_url()}"
+        response = self.do_request(upload_url, "POST", headers=headers)
+        session_url = self._get_location(response, container)
+        if not session_url:
+            raise ValueError(f"Issue retrieving session url: {response.reason}")
+
+        start = 0
+        failures = 0
+        accepted = False
+        with open(blob, "rb") as fd:
+            while start < layer["size"]:
+                fd.seek(start)
+                chunk = fd.read(defaults.chunked_upload_size)
+                end = start + len(chunk) - 1
+                headers = {
+                    "Content-Range": f"{start}-{end}",
+                    "Content-Length": str(len(chunk)),
+                    "Content-Type": "application/octet-stream",
+                }
+                headers.update(self.headers)
+                try:
+                    response = self.do_request(
+                        session_url, "PATCH", data=chunk, headers=headers
+                    )
+                    self._check_200_response(response)
+                except Exception as e:
+                    if not accepted:
+                        logger.info(
+                            f"Cannot upload {blob} in chunks ({e}), sending it whole"
+                        )
+                        self.cancel_upload(session_url)
+                        return self.upload_blob(blob, container, layer)
+                    failures += 1
+                    if failures > defaults.chunked_upload_attempts:
+                        raise
+                    logger.info(f"Chunk {start}-{end} of {blob} failed: {e}")
+                    time.sleep(2**failures)
+                    session_url, start = self.get_upload_offset(session_url, container)
+                    logger.info(f"Resuming upload of {blob} from byte {start}")
+                    continue
+
+                # The next chunk goes to the location the registry gives back
+                session_url = self._get_location(response, container) or session_url
+                start = end + 1
+                accepted = True
+                failures = 0
+
+        # Finally, issue a PUT request to close the blob
+        session_url = oraslib.utils.append_url_params(
+            session_url, {"digest": layer["digest"]}
+        )
+        for attempt in range(defaults.chunked_upload_attempts + 1):
+            try:
+                response = self.do_request(session_url, "PUT", headers=self.headers)
+                self._check_200_response(response)
+                return response
+            except Exception as e:
+                if attempt == defaults.chunked_upload_attempts:
+                    raise
+                logger.info(f"Closing the upload of {blob} failed: {e}")
+                time.sleep(2 ** (attempt + 1))
+
+            # The PUT may have worked even if we didn't hear back
+            response = self.get_blob(container, layer["digest"], head=True)
+            if response.status_code == 200:
+                return response
+
     @ensure_container
     def push(self, container, archives: list):
         """
         Given a dict of layers (paths and corresponding mediaType) push.
+
+        Blobs that already exist in the repository are not uploaded again.
+        We return the manifest with the number of bytes sent and skipped.
         """
 
         # Prepare a new manifest
         manifest = oraslib.oci.NewManifest()
+        result = {"bytes_sent": 0, "bytes_skipped": 0}
 
         # Upload files as blobs
         for item in archives:
@@ -172,8 +699,15 @@ class Registry(oras.provider.Registry):
                 blob = oraslib.utils.make_targz(blob)
                 cleanup_blob = True
 
-            # Create a new layer from the blob
-            layer = oraslib.oci.NewLayer(blob, media_type, is_dir=cleanup_blob)
+            # Create a new layer from the blob, unless we know its digest
+            if item.get("digest") and item.get("size") is not None and not cleanup_blob:
+                layer = {
+                    "mediaType": media_type,
+                    "size": item["size"],
+                    "digest": item["digest"],
+                }
+            else:
+                layer = oraslib.oci.NewLayer(blob, media_type, is_dir=cleanup_blob)
             logger.debug(f"Preparing layer {layer}")
 
             # Update annotations with title we will need for extraction
@@ -183,10 +717,12 @@ class Registry(oras.provider.Registry):
             # update the manifest with the new layer
             manifest["layers"].append(layer)
 
-            # Upload the blob layer
+            # Upload the blob layer, if the registry doesn't have it
             logger.info(f"Uploading {blob_name} to {container.uri}")
-            response = self.upload_blob(blob, container, layer)
-            self._check_200_response(response)
+            if self.ensure_blob(blob, container, layer):
+                result["bytes_sent"] += layer["size"]
+            else:
+                result["bytes_skipped"] += layer["size"]
 
             # Do we need to cleanup a temporary targz?
             if cleanup_blob and os.path.exists(blob):
@@ -197,15 +733,208 @@ class Registry(oras.provider.Registry):
         conf, config_file = oraslib.oci.ManifestConfig()
 
         # Config is just another layer blob!
-        response = self.upload_blob(config_file, container, conf)
-        self._check_200_response(response)
+        if self.ensure_blob(config_file, container, conf):
+            result["bytes_sent"] += conf["size"]
+        else:
+            result["bytes_skipped"] += conf["size"]
 
-        # Final upload of the manifest
+        # Final upload of the manifest, the registry tells us its digest
         manifest["config"] = conf
-        self._check_200_response(self.upload_manifest(manifest, container))
-        print(f"Successfully pushed {container}")
+        response = self.upload_manifest(manifest, container)
+        self._check_200_response(response)
+        result["digest"] = response.headers.get("Docker-Content-Digest")
+        print(
+            f"Successfully pushed {container} ({result['bytes_sent']} bytes sent, {result['bytes_skipped']} bytes skipped)"
+        )
+        self.add_snapshot_tag(container)
+        result["manifest"] = manifest
+        return result
+
+    def do_request(
+        self, url, method="GET", data=None, headers=None, json=None, stream=False
+    ):
+        """
+        Do a request, retrying with authentication after a 401 (or 404).
+
+        This is the oras do_request, but a response we don't return is closed,
+        so a streamed one gives its connection back to the pool.
+        """
+        headers = headers or {}
+
+        def request():
+            return self.session.request(
+                method, url, data=data, json=json, headers=headers, stream=stream
+            )
+
+        # A 401 response is a request for authentication
+        response = request()
+        if response.status_code not in [401, 404]:
+            return response
+
+        if self.authenticate_request(response):
+            response.close()
+            headers.update(self.headers)
+            response = request()
+
+        # Fallback to using Authorization if already required (as oras does)
+        if response.status_code in [401, 404] and "Authorization" in self.headers:
+            logger.debug("Trying with provided Basic Authorization...")
+            response.close()
+            headers.update(self.headers)
+            response = request()
         return response
 
+    def authenticate_request(self, originalResponse):
+        """
+        Authenticate a request with a bearer token, reusing a cached one.
+
+        Tokens are cached by (realm, service, scope) until they expire.
+        """
+        challenge = originalResponse.headers.get("Www-Authenticate")
+
+        # A basic challenge is answered with our credentials, not a token
+        if challenge and challenge.lower().startswith("basic"):
+            if not self._basic_auth:
+                return False
+            self.headers.update({"Authorization": f"Basic {self._basic_auth}"})
+            return True
+
+        if self.token or not challenge or not challenge.lower().startswith("bearer"):
+            return super().authenticate_request(originalResponse)
+
+        h = oraslib.auth.parse_auth_header(challenge)
+        if not h.realm:
+            return super().authenticate_request(originalResponse)
+        registry = urllib.parse.urlparse(originalResponse.url).netloc
+        self.auth_challenges[registry] = (h.realm, h.service)
+
+        # A cached token the registry just refused should not be tried again
+        sent = originalResponse.request.headers.get("Authorization")
+        token = self.get_cached_token(h.realm, h.service, h.scope)
+        if token and sent == f"Bearer {token}":
+            token = None
+        token = token or self.request_token(h.realm, h.service, [h.scope])
+        if not token:
+            return False
+        self.headers.update({"Authorization": f"Bearer {token}"})
+        return True
+
+    def get_cached_token(self, realm, service, scope):
+        """
+        Get an unexpired token for a scope (or one that includes it)
+        """
+        for candidate in scope_candidates(scope):
+            cached = self.tokens.get((realm, service, candidate))
+            if cached and cached["expires"] > time.time():
+                return cached["token"]
+
+    def request_token(self, realm, service, scopes):
+        """
+        Request a token for one or more scopes, and cache it for each.
+        """
+        scopes = [x for x in scopes if x]
+        params = {"scope": scopes}
+        if service:
+            params["service"] = service
+
+        # The token is anonymous unless we have basic auth
+        headers = {}
+        if self._basic_auth:
+            headers["Authorization"] = f"Basic {self._basic_auth}"
+
+        url = realm if realm.startswith("http") else f"{self.prefix}://{realm}"
+        response = self.session.get(url, headers=headers, params=params)
+        if response.status_code != 200:
+            logger.debug(f"Token request was not successful: {response.text}")
+            return
+
+        # The spec says to assume 60 seconds if expires_in is missing
+        info = response.json()
+        token = info.get("token") or info.get("access_token")
+        if not token:
+            return
+        expires = (
+            time.time() + info.get("expires_in", 60) - defaults.token_expiry_margin
+        )
+        for scope in scopes or [None]:
+            self.tokens[(realm, service, scope)] = {"token": token, "expires": expires}
+        return token
+
+    def prefetch_tokens(self, repositories, actions="pull,push"):
+        """
+        Request tokens for repositories we will soon interact with.
+
+        Scopes without a cached token are requested together, so one round
+        trip covers many repositories.
+        """
+        by_registry = {}
+        for repository in repositories:
+            container = self.get_container(repository)
+            by_registry.setdefault(container.registry, set()).add(
+                f"repository:{container.api_prefix}:{actions}"
+            )
+
+        for registry, scopes in by_registry.items():
+            if registry not in self.auth_challenges:
+                self.auth_challenges[registry] = self.get_auth_challenge(registry)
+            if not self.auth_challenges[registry]:
+                continue
+            realm, service = self.auth_challenges[registry]
+            missing = [
+                x for x in scopes if not self.get_cached_token(realm, service, x)
+            ]
+            if missing:
+                logger.debug(f"Requesting tokens for {len(missing)} repositories")
+                self.request_token(realm, service, sorted(missing))
+
+    def get_auth_challenge(self, registry):
+        """
+        Ask a registry for the realm and service to get bearer tokens from.
+        """
+        response = self.session.get(f"{self.prefix}://{registry}/v2/")
+        challenge = response.headers.get("Www-Authenticate")
+        if response.status_code != 401 or not challenge:
+            return
+        if not challenge.lower().startswith("bearer"):
+            return
+        h = oraslib.auth.parse_auth_header(challenge)
+        if h.realm:
+            return (h.realm, h.service)
+
+    @ensure_container
+    def tag(self, container, manifest):
+        """
+        Tag an already pushed manifest by uploading it again under a new tag.
+        """
+        self._check_200_response(self.upload_manifest(manifest, container))
+        self.add_snapshot_tag(container)
+        print(f"Successfully tagged {container}")
+
+
+class LazyClient:
+    """
+    The global oras client, created the first time it is used.
+
+    Processes that only prepare package metadata import this module too,
+    and shouldn't create a client (or warn about its credentials).
+    """
+
+    def __init__(self):
+        object.__setattr__(self, "_client", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def get(self):
+        with self._lock:
+            if self._client is None:
+                object.__setattr__(self, "_client", get_oras_client())
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get(), name, value)
+
 
 # Create global oras client to manage mirrors
-oras = get_oras_client()
+oras = LazyClient()
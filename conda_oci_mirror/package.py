@@ -1,74 +1,152 @@
 # Packages and functions for them
 
+import contextlib
 import hashlib
+import io
 import json
 import os
 import pathlib
-import platform
-import shutil
+import tarfile
 import tempfile
+import zipfile
 
-import requests
-from conda_package_handling import api
+import zstandard as zstd
 
 import conda_oci_mirror.defaults as defaults
+import conda_oci_mirror.sessions as sessions
 import conda_oci_mirror.util as util
+from conda_oci_mirror.cache import MetadataCache
 from conda_oci_mirror.decorators import classretry, retry
 from conda_oci_mirror.logger import logger
 from conda_oci_mirror.oras import Pusher
 
+# Files pushed with a package archive, relative to its staging directory
+info_files = ["info.tar.gz", "info/index.json"]
 
-def check_checksum(path, package_dict):
+# Set with set_cache_dir to cache package info metadata on disk
+metadata_cache = None
+
+
+def set_cache_dir(cache_dir):
     """
-    Ensure the checksum (if exists) matches
+    Keep package info metadata (by archive sha256) under a cache directory.
     """
-    if "sha256" in package_dict:
-        hash_func = hashlib.sha256()
-        expected = package_dict["sha256"]
-    elif "md5" in package_dict:
-        hash_func = hashlib.md5()
-        expected = package_dict["md5"]
-    else:
-        logger.warning("NO HASHES FOUND!")
-        return True
+    global metadata_cache
+    metadata_cache = MetadataCache(
+        os.path.join(cache_dir, ".metadata"),
+        max_bytes=defaults.metadata_cache_max_bytes,
+    )
 
-    with open(path, "rb") as f:
-        # Read and update hash string value in blocks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            hash_func.update(byte_block)
 
-    if hash_func.hexdigest() != expected:
-        return False
-    else:
-        return True
+def check_checksum(digests, package_dict):
+    """
+    Ensure the checksum (if exists) matches the digests of a download
+    """
+    if "sha256" in package_dict:
+        return digests["sha256"] == package_dict["sha256"]
+    if "md5" in package_dict:
+        return digests["md5"] == package_dict["md5"]
+    logger.warning("NO HASHES FOUND!")
+    return True
 
 
-def _download_file_once(url, dest, checksum_content=None, chunk_size=8192):
+def _download_file_once(url, dest, checksum_content=None, chunk_size=1024 * 1024):
     """
-    Stream download a file!
+    Stream download a file, returning its digests (sha256, md5 and size).
+
+    The digests are computed as the bytes arrive, so we don't read the
+    file again to check or push it.
     """
-    with requests.get(url, stream=True, allow_redirects=True) as r:
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    size = 0
+    session = sessions.get_session()
+    with session.get(url, stream=True, allow_redirects=True) as r:
         r.raise_for_status()
         with open(dest, "wb") as f:
             for chunk in r.iter_content(chunk_size=chunk_size):
+                sha256.update(chunk)
+                md5.update(chunk)
+                size += len(chunk)
                 f.write(chunk)
-
-    # If we aren't given a checksum, we're done!
-    if not checksum_content:
-        return dest
+    digests = {"sha256": sha256.hexdigest(), "md5": md5.hexdigest(), "size": size}
 
     # Do a checksum validation if given one.
-    if check_checksum(dest, checksum_content) is False:
+    if checksum_content and check_checksum(digests, checksum_content) is False:
         if os.path.exists(dest):
             os.remove(dest)
         raise RuntimeError("checksums wrong")
 
-    return dest
+    # Other readers of the file can find its sha256 without hashing it
+    util.write_digest_sidecar(dest, digests["sha256"])
+    return digests
 
 
 download_file = retry(attempts=5, timeout=2)(_download_file_once)
 
 
+@contextlib.contextmanager
+def open_info_tar(path):
+    """
+    Open a tar stream of the info/ metadata of a package archive.
+
+    A .conda is a zip with the metadata in its own info-*.tar.zst member, so
+    we only decompress that. For a .tar.bz2 we read the whole tarball.
+    """
+    if path.endswith(".conda"):
+        with zipfile.ZipFile(path) as archive:
+            members = [
+                name
+                for name in archive.namelist()
+                if name.startswith("info-") and name.endswith(".tar.zst")
+            ]
+            if not members:
+                raise ValueError(f"{path} does not have an info-*.tar.zst member")
+            with archive.open(members[0]) as fd:
+                reader = zstd.ZstdDecompressor().stream_reader(fd)
+                with tarfile.open(fileobj=reader, mode="r|") as tar:
+                    yield tar
+    else:
+        with tarfile.open(path, mode="r|bz2") as tar:
+            yield tar
+
+
+def write_info(path, dest_dir):
+    """
+    Write info.tar.gz and info/index.json for a package archive to dest_dir.
+
+    Entries are streamed from the archive into info.tar.gz (named relative
+    to info/), and nothing else is extracted. A .tar.bz2 can have its info
+    entries anywhere (e.g., between other files), so we read all of it.
+    """
+    index_file = os.path.join(dest_dir, "info", "index.json")
+    util.mkdir_p(os.path.dirname(index_file))
+
+    with open_info_tar(path) as tar, tarfile.open(
+        os.path.join(dest_dir, "info.tar.gz"), "w:gz", compresslevel=6
+    ) as info:
+        for member in tar:
+            if not member.name.startswith("info/"):
+                continue
+            member.name = member.name[len("info/") :]
+            if not member.name:
+                continue
+            if member.islnk() and member.linkname.startswith("info/"):
+                member.linkname = member.linkname[len("info/") :]
+            if not member.isfile():
+                info.addfile(member)
+                continue
+
+            content = tar.extractfile(member).read()
+            if member.name == "index.json":
+                with open(index_file, "wb") as fd:
+                    fd.write(content)
+            info.addfile(member, io.BytesIO(content))
+
+    if not os.path.exists(index_file):
+        raise ValueError(f"{path} does not have info/index.json")
+
+
 def reverse_version_build_tag(tag: str):
     return tag.replace("__p__", "+").replace("__e__", "!").replace("__eq__", "=")
 
@@ -102,6 +180,9 @@ class Package:
         self.file = existing_file
         self.timestamp = timestamp
 
+        # The sha256, md5 and size of the file, computed once
+        self.digests = None
+
     def ensure_file(self):
         """
         Ensure self.file has been downloaded, and exists.
@@ -114,16 +195,26 @@ class Package:
             )
             dest = os.path.join(self.cache_dir, self.package)
 
-            # Download the file and return its path (default is to stream)
+            # Download the file and keep its digests (default is to stream)
             try:
-                self.file = download_file(urls[0], dest, self.package_info)
+                self.digests = download_file(urls[0], dest, self.package_info)
             except Exception as exc:
                 logger.warning(
                     f"Main URL {urls[0]} failed. Retrying with fallback {urls[1]}. "
                     f"{exc.__class__.__name__}: {exc}"
                 )
                 # We don't want to spam conda-web too much, so no retries
-                self.file = _download_file_once(urls[1], dest, self.package_info)
+                self.digests = _download_file_once(urls[1], dest, self.package_info)
+            self.file = dest
+
+    def ensure_digests(self):
+        """
+        Ensure we have the digests of the file (e.g., a file we didn't download)
+        """
+        if self.digests is None:
+            self.digests = util.file_digests(self.file)
+            util.write_digest_sidecar(self.file, self.digests["sha256"])
+        return self.digests
 
     @property
     def package_name(self):
@@ -133,7 +224,8 @@ class Package:
         if self._package_name is not None:
             return self._package_name
 
-        name = pathlib.Path(self.file).name
+        # Before a download we only know the package filename
+        name = pathlib.Path(self.file or self.package).name
         for ext in [".tar.bz2", ".conda"]:
             if name.endswith(ext):
                 self._package_name = name[: -len(ext)]
@@ -147,6 +239,36 @@ class Package:
         """
         return self.package_name.rsplit("-", 2)[0]
 
+    @property
+    def repository(self):
+        """
+        The repository (without a tag) the package is pushed to.
+        """
+        # Is this a private or similar package? (not sure what this is doing)
+        name = self.package_name_bare
+        if name.startswith("_"):
+            name = f"zzz{name}"
+        return f"{self.registry}/{self.channel}/{self.subdir}/{name}"
+
+    @property
+    def filename(self):
+        """
+        The package archive filename (e.g., zlib-1.2.11-0.tar.bz2)
+        """
+        return pathlib.Path(self.file or self.package).name
+
+    @property
+    def sha256(self):
+        """
+        The sha256 of the package archive, from the repodata if we have it.
+        """
+        if self.digests:
+            return self.digests["sha256"]
+        if self.package_info and "sha256" in self.package_info:
+            return self.package_info["sha256"]
+        if self.file and os.path.exists(self.file):
+            return util.cached_sha256sum(self.file)
+
     @property
     def tag(self):
         return "-".join(self.package_name.rsplit("-", 2)[1:])
@@ -166,31 +288,105 @@ class Package:
     def prepare_metadata(self, staging_dir):
         """
         Prepare package metadata for upload
+
+        info/index.json and info.tar.gz are written straight from the archive
+        into the staging directory, where they are pushed from. With a
+        metadata cache they are written from the cache if we have seen the
+        archive (by sha256) before. Returns the digest and size of each file
+        if we know them.
         """
         dest_dir = os.path.join(staging_dir, self.package_name)
-        util.mkdir_p(dest_dir)
-
-        # Extract to another temporary location
-        with tempfile.TemporaryDirectory() as temp_dir:
-            logger.debug(f"Extracting {self.file} to {temp_dir}")
-            api.extract(self.file, temp_dir, components=["info"])
-
-            index_json = os.path.join(temp_dir, "info", "index.json")
-            info_archive = os.path.join(temp_dir, "info.tar.gz")
-            util.compress_folder(
-                os.path.join(temp_dir, "info"), os.path.join(temp_dir, "info.tar.gz")
-            )
-            util.mkdir_p(os.path.join(dest_dir, "info"))
-            shutil.copy(info_archive, os.path.join(dest_dir, "info.tar.gz"))
-            shutil.copy(index_json, os.path.join(dest_dir, "info", "index.json"))
+        if not metadata_cache:
+            logger.debug(f"Writing info for {self.file} to {dest_dir}")
+            write_info(self.file, dest_dir)
+            return {}
+
+        sha256 = self.ensure_digests()["sha256"]
+        entry = metadata_cache.get(sha256)
+        if entry and all(name in entry["layers"] for name in info_files):
+            logger.debug(f"Writing cached info for {self.file} to {dest_dir}")
+            for name in info_files:
+                path = os.path.join(dest_dir, name)
+                util.mkdir_p(os.path.dirname(path))
+                with open(path, "wb") as fd:
+                    fd.write(entry["layers"][name]["content"])
+        else:
+            logger.debug(f"Writing info for {self.file} to {dest_dir}")
+            write_info(self.file, dest_dir)
+            files = {}
+            for name in info_files:
+                with open(os.path.join(dest_dir, name), "rb") as fd:
+                    files[name] = fd.read()
+            entry = metadata_cache.set(sha256, files)
+
+        return {
+            name: {"digest": layer["digest"], "size": layer["size"]}
+            for name, layer in entry["layers"].items()
+        }
 
-    @classretry
     def upload(self, dry_run=False, extra_tags=None, timestamp=None):
         """
         Upload a conda package archive.
         """
+        with tempfile.TemporaryDirectory() as staging_dir:
+            pusher = self.prepare_upload(staging_dir, timestamp)
+            return self.push(pusher, dry_run, extra_tags)
+
+    def prepare_upload(self, staging_dir, timestamp=None):
+        """
+        Prepare the layers of a package archive to push from a staging directory.
+        """
         # Optionally honor the timestamp provided by the package
         timestamp = timestamp or self.timestamp
+        pusher = Pusher(staging_dir, timestamp=timestamp)
+
+        # Prepare metadata in the staging directory
+        info_layers = self.prepare_metadata(staging_dir)
+
+        # The archive is pushed from where it is (it isn't copied to staging)
+        # title is used for archive name (path extracted to) as if in staging
+        archive = os.path.abspath(self.file)
+        title = os.path.basename(archive)
+        media_type = (
+            defaults.package_tarbz2_media_type
+            if archive.endswith("tar.bz2")
+            else defaults.package_conda_media_type
+        )
+
+        # Annotations are only included with tar.bz2
+        # The digests were computed with the download (or once here)
+        digests = self.ensure_digests()
+        annotations = None
+        if media_type in [
+            defaults.package_conda_media_type,
+            defaults.package_tarbz2_media_type,
+        ]:
+            annotations = {"org.conda.md5": digests["md5"]}
+        pusher.add_layer(
+            archive,
+            media_type,
+            title,
+            annotations,
+            digest=f"sha256:{digests['sha256']}",
+            size=digests["size"],
+        )
+
+        for name, media_type in zip(
+            info_files,
+            [defaults.info_archive_media_type, defaults.info_index_media_type],
+        ):
+            pusher.add_layer(
+                f"{self.package_name}/{name}",
+                media_type,
+                **info_layers.get(name, {}),
+            )
+        return pusher
+
+    @classretry
+    def push(self, pusher, dry_run=False, extra_tags=None):
+        """
+        Push the layers prepared for a package archive.
+        """
         extra_tags = extra_tags or []
 
         # Return list of items we uploaded
@@ -200,72 +396,26 @@ class Package:
         if not isinstance(extra_tags, (list, set, tuple)):
             extra_tags = set([extra_tags])
 
-        with tempfile.TemporaryDirectory() as staging_dir:
-            pusher = Pusher(staging_dir, timestamp=timestamp)
-            upload_files_path = pathlib.Path(staging_dir)
-            shutil.copy(self.file, staging_dir)
-
-            # Prepare metadata in same staging directory
-            self.prepare_metadata(staging_dir)
-
-            # The new archive is the old filename in the new directory
-            archive = os.path.join(staging_dir, os.path.basename(self.file))
-
-            # title is used for archive name (path extracted to) so relative to root
-            title = os.path.relpath(archive, staging_dir)
-            media_type = (
-                defaults.package_tarbz2_media_type
-                if archive.endswith("tar.bz2")
-                else defaults.package_conda_media_type
-            )
-
-            # Annotations are only included with tar.bz2
-            annotations = None
-            if media_type in [
-                defaults.package_conda_media_type,
-                defaults.package_tarbz2_media_type,
-            ]:
-                annotations = {"org.conda.md5": util.md5sum(archive)}
-            pusher.add_layer(archive, media_type, title, annotations)
-
-            # creation of info.tar.gz _does not yet work on windows_ properly...
-            if platform.system() != "Windows":
-                pusher.add_layer(
-                    f"{self.package_name}/info.tar.gz", defaults.info_archive_media_type
-                )
-
-            # We always add this layer regardless of platform
-            pusher.add_layer(
-                f"{self.package_name}/info/index.json", defaults.info_index_media_type
+        if dry_run:
+            logger.info(
+                f"Would be pushing to {self.registry}:{json.dumps(pusher.layers, indent=4)}"
             )
+            return items
 
-            if dry_run:
-                logger.info(
-                    f"Would be pushing to {self.registry}:{json.dumps(pusher.layers, indent=4)}"
-                )
-                return items
+        name = self.package_name_bare
+        version_and_build = self.tag
+        index_file = os.path.join(pusher.root, self.package_name, "info", "index.json")
+        index = util.read_json(index_file)
 
-            name = self.package_name_bare
-            version_and_build = self.tag
-            index_file = os.path.join(
-                upload_files_path, self.package_name, "info", "index.json"
+        # The index must contain the subdirectory
+        subdir = index.get("subdir")
+        if not subdir:
+            logger.error(
+                f"info.json for {name}@{version_and_build} doesn't contain subdir!"
             )
-            index = util.read_json(index_file)
+            return
 
-            # The index must contain the subdirectory
-            subdir = index.get("subdir")
-            if not subdir:
-                logger.error(
-                    f"info.json for {name}@{version_and_build} doesn't contain subdir!"
-                )
-                return
-
-            # Is this a private or similar package? (not sure what this is doing)
-            if name.startswith("_"):
-                name = f"zzz{name}"
-
-            # Push main tag and extras
-            uri = f"{self.registry}/{self.channel}/{self.subdir}/{name}"
-            for tag in [self.version_build_tag] + list(extra_tags):
-                items.append(pusher.push(f"{uri}:{tag}"))
-            return items
+        # Push main tag, and extras only tag the same manifest
+        return pusher.push_tags(
+            self.repository, [self.version_build_tag] + list(extra_tags)
+        )
@@ -0,0 +1,207 @@
+# Compact package records and a streaming repodata loader
+
+import json
+import sys
+
+
+class PackageRecord:
+    """
+    The fields of a repodata record that the mirror uses.
+
+    Records are read like the dict they come from (e.g., info["name"]), but
+    keep only these fields in slots, which is a fraction of the memory of
+    the full record with dependencies, licenses, etc.
+    """
+
+    __slots__ = (
+        "name",
+        "version",
+        "build",
+        "build_number",
+        "sha256",
+        "md5",
+        "size",
+        "timestamp",
+    )
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+        # Names are repeated across records, so share one string for each
+        if self.name is not None:
+            self.name = sys.intern(self.name)
+
+    @classmethod
+    def from_dict(cls, info):
+        return cls(**{k: v for k, v in info.items() if k in cls.__slots__})
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def __eq__(self, other):
+        if isinstance(other, PackageRecord):
+            return self.to_dict() == other.to_dict()
+        return NotImplemented
+
+    def __repr__(self):
+        return f"PackageRecord({self.to_dict()})"
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return [field for field in self.__slots__ if field in self]
+
+    def items(self):
+        return [(field, self[field]) for field in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+class JsonStream:
+    """
+    Decode json values one at a time from a file read in chunks.
+    """
+
+    whitespace = " \t\n\r"
+
+    def __init__(self, fd, chunk_size=1024 * 1024):
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.done = False
+
+    def fill(self):
+        """
+        Read another chunk into the buffer, dropping what we have parsed.
+        """
+        chunk = self.fd.read(self.chunk_size)
+        if not chunk:
+            self.done = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Get the next character that isn't whitespace (without consuming it).
+        """
+        while True:
+            while self.pos < len(self.buffer):
+                if self.buffer[self.pos] not in self.whitespace:
+                    return self.buffer[self.pos]
+                self.pos += 1
+            if not self.fill():
+                return ""
+
+    def expect(self, chars):
+        """
+        Consume the next character, which must be one of chars.
+        """
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Expected one of {chars} at {self.pos}, found {char}")
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """
+        Decode the next value, reading more if it runs past the buffer.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+
+                # A number at the end of the buffer might continue in the next
+                if end < len(self.buffer) or self.done or not self.fill():
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+
+
+def load_repodata(filename, package_types):
+    """
+    Load repodata, keeping compact records for the package types.
+
+    Records are decoded one at a time, so we never hold the whole file or
+    all of its full records in memory. Other top level values are kept.
+    """
+    data = {}
+    with open(filename, encoding="utf-8") as fd:
+        stream = JsonStream(fd)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return data
+
+        while True:
+            key = stream.decode()
+            stream.expect(":")
+            if key in package_types:
+                data[key] = load_records(stream)
+            else:
+                data[key] = stream.decode()
+            if stream.expect(",}") == "}":
+                return data
+
+
+def load_records(stream):
+    """
+    Load a json object of package file names to compact records.
+    """
+    return {
+        package_file: PackageRecord.from_dict(info)
+        for package_file, info in iter_records(stream)
+    }
+
+
+def iter_records(stream):
+    """
+    Yield (package file, full record) from a json object of package records.
+    """
+    stream.expect("{")
+    if stream.peek() == "}":
+        stream.pos += 1
+        return
+
+    while True:
+        package_file = stream.decode()
+        stream.expect(":")
+        yield package_file, stream.decode()
+        if stream.expect(",}") == "}":
+            return
+
+
+class ObjectWriter:
+    """
+    Write the items of a json object one at a time.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.count = 0
+        out.write("{")
+
+    def write_key(self, key):
+        self.out.write(("," if self.count else "") + json.dumps(key) + ":")
+        self.count += 1
+
+    def write(self, key, value):
+        self.write_key(key)
+        self.out.write(json.dumps(value, separators=(",", ":")))
+
+    def close(self):
+        self.out.write("}")
@@ -1,23 +1,86 @@
 # Packages and functions for them
 
+import bz2
 import datetime
 import fnmatch
+import gzip
 import os
+import shutil
 import tarfile
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import packaging.version
-import requests
 import zstandard as zstd
 
 import conda_oci_mirror.decorators as decorators
 import conda_oci_mirror.defaults as defaults
+import conda_oci_mirror.jlap as jlap
+import conda_oci_mirror.records as records
+import conda_oci_mirror.sessions as sessions
+import conda_oci_mirror.state as sync_state
 import conda_oci_mirror.util as util
+import conda_oci_mirror.versions as versions
 from conda_oci_mirror.logger import logger
 from conda_oci_mirror.oras import Pusher, oras
 from conda_oci_mirror.package import reverse_version_build_tag
 
+
+class TagsCache:
+    """
+    Existing (reversed) tags by registry repository, safe to use from threads.
+
+    Concurrent requests for the same repository wait for one lookup.
+    """
+
+    def __init__(self):
+        self.tags = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.tags
+
+    def __getitem__(self, key):
+        with self.lock:
+            return self.tags[key]
+
+    def __setitem__(self, key, tags):
+        with self.lock:
+            self.tags[key] = tags
+
+    def get_or_set(self, key, func):
+        """
+        Get tags for a key, calling func to look them up if we don't have them.
+
+        An error from func is raised (and nothing is cached).
+        """
+        while True:
+            with self.lock:
+                if key in self.tags:
+                    return self.tags[key]
+                event = self.pending.get(key)
+                if event is None:
+                    event = self.pending[key] = threading.Event()
+                    break
+
+            # Someone else is looking up the key, wait and check again
+            event.wait()
+
+        try:
+            tags = func()
+            with self.lock:
+                self.tags[key] = tags
+            return tags
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+
+
 # This is shared between PackageRepo instances
-existing_tags_cache = {}
+existing_tags_cache = TagsCache()
 
 
 # Mapping of extensions to media types
@@ -26,6 +89,26 @@ package_extensions = {
     "conda": defaults.package_conda_media_type,
 }
 
+# Mapping of compressed repodata extensions to media types
+repodata_compressions = {
+    "zst": defaults.repodata_media_type_v1_zst,
+    "bz2": defaults.repodata_media_type_v1_bz2,
+    "gz": defaults.repodata_media_type_v1_gz,
+}
+
+
+def get_decompressor(url):
+    """
+    Get a streaming decompressor for a compressed repodata url, if needed.
+
+    Plain json is still compressed over the wire (Accept-Encoding), which
+    requests decodes as we stream.
+    """
+    if url.endswith(".zst"):
+        return zstd.ZstdDecompressor().decompressobj()
+    if url.endswith(".bz2"):
+        return bz2.BZ2Decompressor()
+
 
 class RepoData:
     """
@@ -39,6 +122,7 @@ class RepoData:
         # We don't expose this yet, but eventually could
         self.package_types = package_types or ["packages", "packages.conda"]
         self.data = {package_type: {} for package_type in self.package_types}
+        self.reset_index()
 
         # Loading data here (or with load) over-rides the dummy empty data above
         if filename is not None:
@@ -47,9 +131,40 @@ class RepoData:
     def load(self, filename):
         """
         Load a filename into the repository data.
+
+        Package records are streamed from the file and kept as compact
+        records with only the fields we use.
         """
         self.filename = os.path.abspath(filename)
-        self.data = util.read_json(filename)
+        self.data = records.load_repodata(filename, self.package_types)
+        self.reset_index()
+
+    def reset_index(self):
+        """
+        Reset the lookups built from the data (e.g., after loading new data)
+        """
+        self._by_name = None
+        self._archives = None
+        self._latest = {}
+
+    def build_index(self):
+        """
+        Build the lookups of records by package name and archive file names.
+        """
+        self._by_name = {}
+        self._archives = set()
+        for package_file, info in self.packages:
+            self._by_name.setdefault(info["name"], []).append((package_file, info))
+            self._archives.add(package_file)
+
+    @property
+    def by_name(self):
+        """
+        Lookup of package name to (package file, info) records
+        """
+        if self._by_name is None:
+            self.build_index()
+        return self._by_name
 
     @property
     def packages(self):
@@ -63,9 +178,11 @@ class RepoData:
     @property
     def package_archives(self):
         """
-        Return flat list of package archive file names
+        Return set of package archive file names
         """
-        return [x[0] for x in list(self.packages)]
+        if self._archives is None:
+            self.build_index()
+        return self._archives
 
     def filtered_packages(self, names):
         """
@@ -74,11 +191,9 @@ class RepoData:
         # We can optionally accept a single string name
         if isinstance(names, str):
             names = [names]
-        names = set(names)
-        for package_file, info in self.packages:
-            if info["name"] not in names:
-                continue
-            yield package_file, info
+        for name in set(names):
+            for package_file, info in self.by_name.get(name, []):
+                yield package_file, info
 
     def get_package_extension(self, pkg):
         """
@@ -103,11 +218,21 @@ class RepoData:
         """
         Return unique set of package names
         """
-        return set(x[1]["name"] for x in self.packages)
+        return set(self.by_name)
 
     def get_latest_tag(self, package):
         """
         Try to get the latest tag based on build number / version string.
+
+        The latest tag for each package is only worked out once.
+        """
+        if package not in self._latest:
+            self._latest[package] = self.find_latest_tag(package)
+        return self._latest[package]
+
+    def find_latest_tag(self, package):
+        """
+        Find the latest tag for a package among its records.
         """
         # Subset to the info of those we care about
         subset = [info for _, info in self.filtered_packages(package)]
@@ -129,12 +254,9 @@ class RepoData:
             if entry["version"] in packages and is_newer:
                 packages[entry["version"]] = entry
 
-        # Find latest tag from set of highest build numbers
-        tags = list(packages)
-        tags.sort(key=packaging.version.Version)
-
+        # Find latest tag from set of highest build numbers (in conda's order)
         # The tag is technically the version + build number
-        latest = packages[tags[-1]]
+        latest = packages[versions.latest_version(packages)]
         return f"{latest['version']}-{latest['build']}"
 
 
@@ -145,12 +267,21 @@ class PackageRepo:
     Note that a PackageRepo can be used as the previous "SubdirAccessor"
     """
 
-    def __init__(self, channel, subdir, cache_dir, registry=None):
+    def __init__(
+        self, channel, subdir, cache_dir, registry=None, state=None, fetched=None
+    ):
         self.channel = channel
         self.subdir = subdir
         self.cache_dir = cache_dir or defaults.CACHE_DIR
         self.timestamp = None
 
+        # Optional sync state of what we have mirrored (across runs)
+        self.state = state
+
+        # Repository metadata already fetched (or revalidated) during this run,
+        # and the package files added and removed (if updated incrementally)
+        self.fetched = {} if fetched is None else fetched
+
         # Can be over-ridden by upload/tags/packages functions if desired
         self.registry = registry
 
@@ -242,27 +373,229 @@ class PackageRepo:
     def ensure_repodata(self):
         """
         Ensure respository metadata is freshly downloaded.
+
+        Each subdir is fetched (or revalidated) at most once per run.
         """
+        if self.repodata in self.fetched:
+            if not self.timestamp:
+                self.ensure_timestamp()
+            return
+
         util.mkdir_p(os.path.dirname(self.repodata))
-        logger.info(f"Downloading patches for {self.channel}/{self.subdir}")
+        url = f"https://conda.anaconda.org/{self.channel}/{self.subdir}"
 
         # The repodata is "patched" by this file: repodata_from_packages.json
-        patches = requests.get(
-            f"https://conda.anaconda.org/{self.channel}/{self.subdir}/repodata_from_packages.json",
-            allow_redirects=True,
+        logger.info(f"Downloading patches for {self.channel}/{self.subdir}")
+        self.download_repodata(f"{url}/repodata_from_packages.json", self.patches)
+
+        # Try to apply changes since our last sync before a full download
+        changes = None
+        if defaults.repodata_jlap:
+            changes = self.update_repodata(f"{url}/repodata.jlap", self.repodata)
+        if changes is None:
+            logger.info(f"Downloading fresh repodata for {self.channel}/{self.subdir}")
+            self.download_repodata(f"{url}/repodata.json", self.repodata)
+        self.fetched[self.repodata] = changes
+        self.ensure_timestamp()
+
+    @property
+    def added_packages(self):
+        """
+        Package files added since we last pushed the repodata, or None if we
+        don't know.
+        """
+        changes = self.fetched.get(self.repodata)
+        if changes is not None:
+            return changes[0]
+
+    def mark_synced(self):
+        """
+        Remember that the repodata we have is pushed (with its packages).
+
+        The next update counts the packages added from here, so a package
+        that fails to push (or a run that stops) is counted again.
+        """
+        state_file = self.get_state_file(self.repodata)
+        if not os.path.exists(state_file):
+            return
+        state = util.read_json(state_file)
+        if state.get("blake2b"):
+            state["synced"] = {"blake2b": state["blake2b"], "jlap": state.get("jlap")}
+            util.write_json(state, state_file)
+
+    def get_state_file(self, path):
+        """
+        Get the hidden file with download state for cached repository metadata.
+        """
+        return os.path.join(
+            os.path.dirname(path), f".{os.path.basename(path)}.state.json"
         )
-        logger.info(f"Downloading fresh repodata for {self.channel}/{self.subdir}")
-        repodata = requests.get(
-            f"https://conda.anaconda.org/{self.channel}/{self.subdir}/repodata.json",
-            allow_redirects=True,
+
+    def update_repodata(self, url, path):
+        """
+        Update cached repodata with the patches since our last sync (JLAP).
+
+        We ask for the JLAP file from where we stopped reading last time, and
+        verify its checksum chain from the hash of that line. Patches are
+        applied from the hash of the repodata we have to the latest, and we
+        return the package files added and removed since the repodata we
+        last pushed (see mark_synced), or (None, None) if we don't know.
+        None means we cannot update incrementally and need a full download.
+
+        Patched repodata is written in our own (compact) format, so it has
+        a different hash than the upstream file with the same content. The
+        hash of the file we wrote is kept too, to check that the cached copy
+        is still what we wrote before we patch it again.
+        """
+        state_file = self.get_state_file(path)
+        if not os.path.exists(path) or not os.path.exists(state_file):
+            return
+        state = util.read_json(state_file)
+        have = state.get("blake2b")
+        if not have:
+            return
+        if state.get("written") and jlap.file_digest(path) != state["written"]:
+            logger.warning(f"{path} changed since it was written, not patching it")
+            return
+
+        # Start where we last pushed (to count changes since), or where we left
+        # off, falling back to the whole file
+        synced = state.get("synced") or {}
+        attempts = [(0, None)]
+        previous = (synced.get("jlap") if synced else state.get("jlap")) or {}
+        if previous.get("pos") and previous.get("iv"):
+            attempts.insert(0, (previous["pos"], bytes.fromhex(previous["iv"])))
+
+        session = sessions.get_session()
+        for pos, iv in attempts:
+            headers = {"Range": f"bytes={pos}-"} if pos else {}
+            response = session.get(url, headers=headers, allow_redirects=True)
+
+            # The server can ignore the range and send the whole file
+            if response.status_code == 200:
+                pos, iv = 0, None
+            elif response.status_code != 206:
+                logger.debug(f"{url} returned {response.status_code}")
+                continue
+            try:
+                patches, metadata, offset, next_iv = jlap.parse(response.content, iv)
+                break
+            except jlap.JlapError as e:
+                logger.warning(f"Cannot use {url}: {e}")
+        else:
+            return
+
+        # Find the patches from the repodata we have (and pushed) to the latest
+        want = metadata.get("latest")
+        try:
+            found = patches
+            patches = jlap.find_patches(found, have, want)
+            changes = (None, None)
+            if synced.get("blake2b"):
+                since = jlap.find_patches(found, synced["blake2b"], want)
+                changes = jlap.changed_filenames(since)
+        except jlap.JlapError as e:
+            logger.info(f"Cannot update {path} incrementally: {e}")
+            return
+
+        written = state.get("written")
+        if patches:
+            logger.info(f"Applying {len(patches)} patches to {path}")
+            tmp = f"{path}.partial"
+            try:
+                jlap.patch_repodata(path, tmp, patches)
+            except (ValueError, OSError) as e:
+                logger.warning(f"Cannot apply patches to {path}: {e}")
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                return
+            written = jlap.file_digest(tmp)
+            os.replace(tmp, path)
+
+        # Our copy no longer matches the validators for a full download
+        state.update(
+            {
+                "blake2b": want,
+                "written": written,
+                "etag": None,
+                "last_modified": None,
+                "jlap": {"pos": pos + offset, "iv": next_iv.hex()},
+            }
         )
+        util.write_json(state, state_file)
+        return changes
+
+    def download_repodata(self, url, path):
+        """
+        Download repository metadata, unless our cached copy is not modified.
+
+        We prefer a compressed variant of the url (decompressed as it streams
+        to disk) and fall back to plain json. The validators (ETag and
+        Last-Modified) and the variant that worked are kept in a hidden file
+        next to the cached copy. A compressed download that stops before the
+        end of its stream counts as failed. Returns True if the path is up to
+        date.
+        """
+        state_file = self.get_state_file(path)
+        state = {}
+        if os.path.exists(path) and os.path.exists(state_file):
+            state = util.read_json(state_file)
+
+        # Try the variant that worked last time first
+        urls = [f"{url}{ext}" for ext in defaults.repodata_compression] + [url]
+        if state.get("url") in urls:
+            urls.remove(state["url"])
+            urls.insert(0, state["url"])
+
+        session = sessions.get_session()
+        for variant in urls:
+            headers = {}
+            if state.get("url") == variant:
+                if state.get("etag"):
+                    headers["If-None-Match"] = state["etag"]
+                if state.get("last_modified"):
+                    headers["If-Modified-Since"] = state["last_modified"]
+
+            with session.get(
+                variant, headers=headers, stream=True, allow_redirects=True
+            ) as response:
+                if response.status_code == 304:
+                    logger.info(f"{variant} is not modified, using cached {path}")
+                    return True
+                if response.status_code != 200:
+                    logger.debug(f"{variant} returned {response.status_code}")
+                    continue
 
-        # If we retrieve both succesfully, save both for later use
-        if patches.status_code == 200:
-            util.write_file(patches.text, self.patches)
-        if repodata.status_code == 200:
-            util.write_file(repodata.text, self.repodata)
-        self.ensure_timestamp()
+                # Write to a temporary file so a failed download keeps the cache
+                # The hash of the content is what incremental patches refer to
+                decompressor = get_decompressor(variant)
+                hasher = jlap.repodata_hasher()
+                tmp = f"{path}.partial"
+                with open(tmp, "wb") as fd:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        if decompressor:
+                            chunk = decompressor.decompress(chunk)
+                        hasher.update(chunk)
+                        fd.write(chunk)
+
+                # A stream cut short decompresses fine up to where it stops
+                if decompressor and not decompressor.eof:
+                    logger.warning(f"{variant} is truncated, trying the next variant")
+                    os.remove(tmp)
+                    continue
+                os.replace(tmp, path)
+                state = {
+                    "url": variant,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "blake2b": hasher.hexdigest(),
+                    "written": hasher.hexdigest(),
+                    "jlap": state.get("jlap"),
+                    "synced": state.get("synced"),
+                }
+            util.write_json(state, state_file)
+            return True
+        return False
 
     def upload(self, root, registry=None):
         """
@@ -270,7 +603,6 @@ class PackageRepo:
         """
         registry = registry or self.registry
         self.ensure_repodata()
-        pushes = []
 
         # title is used for archive name (path extracted to) so relative to root
         # note that we upload repodata.json here, not the one with yanked packages
@@ -283,37 +615,78 @@ class PackageRepo:
         pusher = Pusher(root, self.timestamp)
         pusher.add_layer(self.repodata, defaults.repodata_media_type_v1, title)
 
-        # compress repodata with zstd
-        compressed = self.compress_repodata()
-        pusher.add_layer(compressed, defaults.repodata_media_type_v1_zst, title)
+        # compress repodata with zstd (and any other variants)
+        for ext, compressed in self.compress_repodata().items():
+            pusher.add_layer(compressed, repodata_compressions[ext], title)
 
-        # Push for a tag for the date, and latest
-        for tag in pusher.created_at, "latest":
-            logger.info(f"  pushing tag {tag}")
-            pushes.append(pusher.push(f"{uri}:{tag}"))
+        # Push for a tag for the date, and tag the same manifest as latest
+        logger.info(f"  pushing tags {pusher.created_at} and latest")
+        return pusher.push_tags(uri, [pusher.created_at, "latest"])
 
-        # Return pushes
-        return pushes
-
-    def compress_repodata(self):
-        # Create a temporary file
-        zst_file = self.repodata + ".zst"
-
-        # Initialize Zstandard compressor
-        cctx = zstd.ZstdCompressor(level=15)
+    def compress_repodata(self, variants=None):
+        """
+        Compress the repodata with zstd, and optionally other variants (bz2, gz).
 
-        with open(self.repodata, "rb") as source_file:
-            # Read the content of the source file
-            data = source_file.read()
+        Variants are compressed in parallel, and each is skipped if the
+        repodata hasn't changed since we last compressed it. We return a
+        lookup of extension to path, with zstd first.
+        """
+        if variants is None:
+            variants = defaults.repodata_compress_variants
+        extensions = ["zst"] + [x for x in variants if x != "zst"]
+        digest = util.cached_sha256sum(self.repodata)
 
-            # Compress the data
-            compressed_data = cctx.compress(data)
+        with ThreadPoolExecutor(max_workers=len(extensions)) as executor:
+            paths = list(
+                executor.map(lambda ext: self.compress_variant(ext, digest), extensions)
+            )
+        return dict(zip(extensions, paths))
 
-            with open(zst_file, "wb") as fout:
-                fout.write(compressed_data)
+    def compress_variant(self, ext, digest):
+        """
+        Compress the repodata as a stream to repodata.json.<ext>
 
-        # Return the path to the temporary file
-        return zst_file
+        The digest of the repodata (and settings) we compressed are kept in
+        a hidden file next to it, so we know when we can skip it.
+        """
+        path = f"{self.repodata}.{ext}"
+        source = os.path.join(
+            os.path.dirname(path), f".{os.path.basename(path)}.source.json"
+        )
+        settings = {"sha256": digest, "level": defaults.repodata_compress_level}
+        if ext == "zst":
+            settings["level"] = defaults.repodata_zstd_level
+        if (
+            os.path.exists(path)
+            and os.path.exists(source)
+            and util.read_json(source) == settings
+        ):
+            logger.info(f"{path} is up to date, not compressing again")
+            return path
+
+        tmp = f"{path}.partial"
+        with open(self.repodata, "rb") as fd:
+            if ext == "zst":
+                cctx = zstd.ZstdCompressor(
+                    level=defaults.repodata_zstd_level,
+                    threads=defaults.repodata_zstd_threads,
+                )
+                with open(tmp, "wb") as out:
+                    cctx.copy_stream(fd, out, size=os.path.getsize(self.repodata))
+            elif ext == "bz2":
+                with bz2.open(tmp, "wb", settings["level"]) as out:
+                    shutil.copyfileobj(fd, out, 1024 * 1024)
+            elif ext == "gz":
+                # Leave out the time, so the same repodata gives the same file
+                with open(tmp, "wb") as raw, gzip.GzipFile(
+                    fileobj=raw, mode="wb", compresslevel=settings["level"], mtime=0
+                ) as out:
+                    shutil.copyfileobj(fd, out, 1024 * 1024)
+            else:
+                raise ValueError(f"Unsupported repodata compression {ext}")
+        os.replace(tmp, path)
+        util.write_json(settings, source)
+        return path
 
     def load_repodata(self, include_yanked=True):
         """
@@ -330,65 +703,186 @@ class PackageRepo:
             return RepoData(self.patches)
         return RepoData(self.repodata)
 
-    def find_packages(self, names=None, skips=None, registry=None, include_yanked=True):
+    def find_packages(
+        self,
+        names=None,
+        skips=None,
+        registry=None,
+        include_yanked=True,
+        changed_only=False,
+        shallow=False,
+    ):
         """
         Given loaded repository data, find packages of interest
+
+        With changed_only, we only look at packages added since we last
+        pushed the repodata, if it was updated incrementally. The changes are
+        those of repodata.json, so that is what we look at (without yanked
+        packages) instead of repodata_from_packages.json. With shallow, we
+        compare against the repodata we last pushed to the registry instead
+        of listing the tags of every package (the deep check).
         """
         registry = registry or self.registry
         skips = skips or []
+        self.ensure_repodata()
+        added = self.added_packages if changed_only else None
+        if added is not None:
+            logger.info(f"Looking at {len(added)} packages added since last sync")
+            include_yanked = False
         repodata = self.load_repodata(include_yanked)
 
+        mirrored = self.get_mirrored_archives(registry) if shallow else None
+        if shallow and mirrored is None:
+            logger.warning(f"No repodata pushed for {self.name}, doing a deep check")
+
         # Look through package info for conda and regular packages
         # These don't overlap, version wise, so it's safe to do.
+        # Match patterns once per package name, not once per record
+        if names:
+            names = set(
+                name
+                for name in repodata.package_names
+                if any(fnmatch.fnmatch(name, x) for x in names)
+            )
+        else:
+            names = None
+
+        selected = []
         for pkg, info in repodata.packages:
+            if added is not None and pkg not in added:
+                continue
+
             # Case 1: we are given packages to filter to
-            if names:
-                if not any(fnmatch.fnmatch(info["name"], x) for x in names):
-                    continue
+            if names is not None and info["name"] not in names:
+                continue
 
             # Case 2: skip it entirely!
             if skips and info["name"] in skips:
                 continue
+            selected.append((pkg, info))
+
+        # Packages the sync state knows we mirrored don't need the registry
+        if self.state is not None:
+            known = self.state.get_subdir(registry, self.channel, self.subdir)
+            selected = [
+                (pkg, info)
+                for pkg, info in selected
+                if not sync_state.is_mirrored(known.get(pkg), info.get("sha256"))
+            ]
+
+        # The shallow check is a difference with what we last pushed
+        if mirrored is not None:
+            for pkg, info in selected:
+                if pkg not in mirrored:
+                    logger.info(f"Adding {pkg} to queue")
+                    yield pkg, info
+            return
 
-            # Existing packages for this will depend on the extension
-            try:
-                existing_packages = self.get_existing_packages(
-                    info["name"],
-                    registry=registry,
-                    package_ext=repodata.get_package_extension(pkg),
-                )
-            except (ValueError, TypeError):
-                logger.warning(f"Package not yet in registry ({pkg})")
-                existing_packages = set()
+        # Records for each package name, to check when its tags come back
+        by_name = {}
+        for pkg, info in selected:
+            by_name.setdefault(info["name"], []).append((pkg, info))
 
-            # This check includes extension, so shouldn't be an issue
-            if pkg not in existing_packages:
-                logger.info(f"Adding {pkg} to queue")
-                yield pkg, info
+        found = []
+        for name, tags in self.iter_existing_tags(by_name, registry=registry):
+            for pkg, info in by_name[name]:
+                # Existing packages for this will depend on the extension
+                ext = repodata.get_package_extension(pkg)
+                existing_packages = set(f"{name}-{tag}.{ext}" for tag in tags)
 
-    def get_existing_tags(self, package, registry=None):
+                # This check includes extension, so shouldn't be an issue
+                if pkg not in existing_packages:
+                    logger.info(f"Adding {pkg} to queue")
+                    yield pkg, info
+                else:
+                    found.append(
+                        (pkg, info.get("sha256"), None, None, sync_state.PUSHED)
+                    )
+
+        # Remember what the registry has, so we don't ask next time
+        if self.state is not None and found:
+            self.state.record_many(registry, self.channel, self.subdir, found)
+
+    def get_mirrored_archives(self, registry=None):
         """
-        Get existing tags for a package name
+        Get the package files in the repodata we last pushed to the registry.
+
+        Returns None if the registry doesn't have repodata for us (yet).
         """
         registry = registry or self.registry
+        uri = f"{registry}/{self.channel}/{self.subdir}/repodata.json:latest"
 
-        global existing_tags_cache
+        # Don't pull over the upstream repodata in the cache
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                res = oras.pull_by_media_type(uri, tmp, defaults.repodata_media_type_v1)
+            except Exception as e:
+                logger.warning(f"Issue retrieving uri: {uri}: {e}")
+                return
+            if not res:
+                return
+            repodata = RepoData(res[0])
+
+        # Files listed as removed (yanked) were not necessarily pushed, so
+        # they aren't counted
+        archives = repodata.package_archives
+        logger.info(f"Found {len(archives)} packages from {uri}")
+        return archives
+
+    def get_container_name(self, package, registry=None):
+        """
+        Get the name of the registry repository for a package.
+        """
+        registry = registry or self.registry
 
         # These are empty packages that serve as helpers
         if package.startswith("_"):
             package = f"zzz{package}"
+        return f"{registry}/{self.channel}/{self.subdir}/{package}"
+
+    def iter_existing_tags(self, packages, registry=None, concurrency=None):
+        """
+        Yield (package name, existing tags) as tags come back from the registry.
+
+        Names are looked up concurrently with a bounded pool of threads, so
+        the caller can act on the first names while the rest are in flight.
+        Packages that are not in the registry yet have no tags.
+        """
+        global existing_tags_cache
+
+        def get_tags(package):
+            gh_name = self.get_container_name(package, registry)
+            try:
+                return self.get_existing_tags(package, registry=registry)
+            except (ValueError, TypeError):
+                logger.warning(f"Package not yet in registry ({gh_name})")
+                existing_tags_cache[gh_name] = []
+            except Exception as e:
+                logger.warning(f"Cannot retrieve tags for {gh_name}: {e}")
+            return []
+
+        packages = list(packages)
+        if packages:
+            logger.info(f"Retrieving tags for {len(packages)} packages")
+        yield from sessions.iter_concurrent(get_tags, packages, concurrency)
+
+    def get_existing_tags(self, package, registry=None):
+        """
+        Get existing (reversed) tags for a package name
+        """
+        registry = registry or self.registry
 
-        if package in existing_tags_cache:
-            return existing_tags_cache[package]
+        global existing_tags_cache
 
-        # GitHub packages name
-        gh_name = f"{registry}/{self.channel}/{self.subdir}/{package}"
+        def get_tags():
+            # We likely want this to raise an error if there is one.
+            tags = oras.get_cached_tags(gh_name)
+            logger.info(f"Found {len(tags)} tags for {gh_name}")
+            return [reverse_version_build_tag(t) for t in tags]
 
-        # We likely want this to raise an error if there is one.
-        tags = oras.get_tags(gh_name, N=100_000_000)
-        logger.info(f"Found {len(tags)} tags for {gh_name}")
-        existing_tags_cache[package] = [reverse_version_build_tag(t) for t in tags]
-        return tags
+        # GitHub packages name (the cache is shared between subdirs)
+        gh_name = self.get_container_name(package, registry)
+        return existing_tags_cache.get_or_set(gh_name, get_tags)
 
     def get_existing_packages(self, package, registry=None, package_ext="conda"):
         """
@@ -0,0 +1,94 @@
+# Pooled http sessions, one per process
+
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import conda_oci_mirror.defaults as defaults
+
+# Number of distinct hosts to keep connection pools for
+pool_hosts = 10
+
+# Connections to keep alive per host, follows the number of workers
+pool_size = 4
+
+# The session is created lazily, and again in a child after a fork
+session = None
+session_pid = None
+
+
+def set_pool_size(size):
+    """
+    Set the number of connections to keep per host (e.g., the number of workers)
+    """
+    global pool_size, session
+    pool_size = max(int(size), 1)
+
+    # The next request will get a session with the new size
+    session = None
+
+
+def ensure_pool_size(size):
+    """
+    Ensure we keep at least size connections per host (e.g., for threads)
+    """
+    if size > pool_size:
+        set_pool_size(size)
+
+
+def new_session():
+    """
+    Create a new session with keep-alive connection pools.
+
+    Connections (and the TLS session that comes with each) are reused across
+    requests to the same host, and we keep up to pool_size of them per host.
+    We don't block when they are all in use (a response that is never
+    closed would hold its connection forever), extra connections are
+    just not kept.
+    """
+    adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+    s = requests.Session()
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+def get_session():
+    """
+    Get the session for this process, creating a new one after a fork.
+
+    A forked worker must not share sockets with its parent.
+    """
+    global session, session_pid
+    if session is None or session_pid != os.getpid():
+        session = new_session()
+        session_pid = os.getpid()
+    return session
+
+
+def iter_concurrent(func, items, concurrency=None):
+    """
+    Yield (item, result) as func returns for each item, from a bounded pool
+    of threads (e.g., read only registry requests).
+
+    An exception is yielded (and not raised) as the result for its item.
+    If the caller stops early, items that are still queued are not started.
+    """
+    concurrency = concurrency or defaults.registry_concurrency
+    items = list(items)
+    if not items:
+        return
+
+    # We need as many connections to a host as requests in flight
+    ensure_pool_size(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(func, x): x for x in items}
+        try:
+            for future in as_completed(futures):
+                error = future.exception()
+                yield futures[future], error or future.result()
+        finally:
+            for future in futures:
+                future.cancel()
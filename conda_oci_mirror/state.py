@@ -0,0 +1,152 @@
+# Local record of mirrored artifacts, kept between runs
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import conda_oci_mirror.util as util
+
+schema = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    registry TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    subdir TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    sha256 TEXT,
+    digest TEXT,
+    tags TEXT,
+    pushed REAL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (registry, channel, subdir, filename)
+)
+"""
+
+# An artifact we pushed, or found in the registry
+PUSHED = "pushed"
+
+# An artifact that failed to push, and should be checked again
+FAILED = "failed"
+
+
+class SyncState:
+    """
+    A sqlite database of artifacts mirrored to registries.
+
+    There is a row per (registry, channel, subdir, filename) with the
+    upstream sha256, the manifest digest we pushed, tags, when it was pushed
+    and a status. Pool workers each open their own connection, and sqlite
+    (in write ahead log mode) serializes their writes.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        util.mkdir_p(os.path.dirname(self.path))
+        with self.lock, self.db:
+            self.db.execute(schema)
+
+    def __getstate__(self):
+        # Connections and locks don't go to worker processes
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.lock = threading.Lock()
+        self._db = None
+        self._pid = None
+
+    @property
+    def db(self):
+        """
+        Get the connection for this process, opening a new one after a fork.
+        """
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._db
+
+    def as_dict(self, row):
+        entry = dict(row)
+        entry["tags"] = json.loads(entry["tags"]) if entry["tags"] else []
+        return entry
+
+    def get(self, registry, channel, subdir, filename):
+        """
+        Get the entry for an artifact, or None if we don't know it.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT * FROM artifacts WHERE registry=? AND channel=? AND subdir=? AND filename=?",
+                (registry, channel, subdir, filename),
+            ).fetchone()
+        if row:
+            return self.as_dict(row)
+
+    def get_subdir(self, registry, channel, subdir):
+        """
+        Get entries for all artifacts of a subdir, by filename.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT * FROM artifacts WHERE registry=? AND channel=? AND subdir=?",
+                (registry, channel, subdir),
+            ).fetchall()
+        return {row["filename"]: self.as_dict(row) for row in rows}
+
+    def record(
+        self,
+        registry,
+        channel,
+        subdir,
+        filename,
+        sha256=None,
+        digest=None,
+        tags=None,
+        status=PUSHED,
+    ):
+        """
+        Record (or update) the state of an artifact.
+        """
+        self.record_many(
+            registry, channel, subdir, [(filename, sha256, digest, tags, status)]
+        )
+
+    def record_many(self, registry, channel, subdir, entries):
+        """
+        Record many (filename, sha256, digest, tags, status) entries at once.
+        """
+        now = time.time()
+        rows = [
+            (
+                registry,
+                channel,
+                subdir,
+                filename,
+                sha256,
+                digest,
+                json.dumps(list(tags)) if tags else None,
+                now if status == PUSHED else None,
+                status,
+            )
+            for filename, sha256, digest, tags, status in entries
+        ]
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+
+def is_mirrored(entry, sha256=None):
+    """
+    Determine if an entry was pushed, and for the same file if we know its sha256.
+    """
+    if not entry or entry["status"] != PUSHED:
+        return False
+    return not sha256 or not entry["sha256"] or entry["sha256"] == sha256
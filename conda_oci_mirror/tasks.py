@@ -1,6 +1,16 @@
 import multiprocessing as mp
+import os
+import queue
+import shutil
+import tempfile
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
 
+import conda_oci_mirror.defaults as defaults
+import conda_oci_mirror.package as pkg
+import conda_oci_mirror.sessions as sessions
+import conda_oci_mirror.state as sync_state
 from conda_oci_mirror.logger import logger
 from conda_oci_mirror.oras import oras
 
@@ -52,36 +62,107 @@ class RepoUploadTask(TaskBase):
         self.wait()
 
         # This has retry wrapper - we get back metadata about the package pushed
-        return self.repo.upload(self.cache_dir, registry=self.registry)
+        result = self.repo.upload(self.cache_dir, registry=self.registry)
+
+        # Changes to the repodata are counted from what we pushed
+        self.repo.mark_synced()
+        return result
 
 
 class PackageUploadTask(TaskBase):
     """
     A single task to upload a package, and cleanup.
+
+    If given a sync state, we record the push (or failure) there.
     """
 
-    def __init__(self, pkg, dry_run=False, wait_time=0.5):
+    def __init__(self, pkg, dry_run=False, wait_time=0.5, state=None):
         self.dry_run = dry_run
         self.pkg = pkg
         self.wait_time = wait_time
+        self.state = state
+
+        # Set by prepare, for push
+        self.staging_dir = None
+        self.pusher = None
+
+    @property
+    def repository(self):
+        """
+        The repository we will push to (to get a token for ahead of time)
+        """
+        if not self.dry_run:
+            return self.pkg.repository
+
+    @property
+    def size(self):
+        """
+        The bytes the package will stage on disk (if we download it)
+        """
+        if self.pkg.file and os.path.exists(self.pkg.file):
+            return 0
+        return (self.pkg.package_info or {}).get("size") or 0
 
     def run(self):
         """
         Run the task. This means:
 
-        1. Creating the package-specific cache directory.
-        2. Downloading the current file.
+        1. Downloading the current file.
+        2. Preparing its metadata in a staging directory.
         3. Upload the package (or emulating it)
         """
+        self.download()
+        try:
+            self.prepare()
+            result = self.push()
+        except Exception:
+            self.cleanup(delete=False)
+            raise
+        self.cleanup()
+        return result
+
+    def download(self):
+        """
+        Download the package file (if we don't have it).
+        """
         self.pkg.ensure_file()
 
+    def prepare(self, executor=None):
+        """
+        Prepare the layers to push in a new staging directory.
+
+        Given an executor (a process pool) the metadata is prepared there.
+        """
+        self.staging_dir = tempfile.mkdtemp(prefix="conda-oci-")
+        try:
+            if executor:
+                future = executor.submit(prepare_upload, self.pkg, self.staging_dir)
+                self.pusher, self.pkg.digests = future.result()
+            else:
+                self.pusher = self.pkg.prepare_upload(self.staging_dir)
+        except Exception:
+            self.record(sync_state.FAILED)
+            raise
+
+    def push(self, client=None):
+        """
+        Push the prepared layers (optionally with a client), and count the package.
+        """
         global package_counter, counter_start
+        if client:
+            self.pusher.client = client
 
         # Wait based on the last upload time across tasks
         self.wait(self.wait_time)
 
         # This has retry wrapper - we get back metadata about the package pushed
-        result = self.pkg.upload(self.dry_run)
+        try:
+            result = self.pkg.push(self.pusher, self.dry_run)
+        except Exception:
+            self.record(sync_state.FAILED)
+            raise
+        if result:
+            self.record(sync_state.PUSHED, result)
 
         with package_counter.get_lock(), counter_start.get_lock():
             package_counter.value += 1
@@ -94,11 +175,37 @@ class PackageUploadTask(TaskBase):
             if package_counter.value % 50 == 0:
                 package_counter.value = 0
                 counter_start.value = time.time()
-
-        # delete the package
-        self.pkg.delete()
         return result
 
+    def cleanup(self, delete=True):
+        """
+        Remove the staging directory and (unless it failed) delete the package.
+        """
+        if self.staging_dir:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+            self.staging_dir = None
+        self.pusher = None
+        if delete:
+            self.pkg.delete()
+
+    def record(self, status, pushes=None):
+        """
+        Record the state of the package (not for a dry run)
+        """
+        if not self.state or self.dry_run:
+            return
+        pushes = pushes or []
+        self.state.record(
+            self.pkg.registry,
+            self.pkg.channel,
+            self.pkg.subdir,
+            self.pkg.filename,
+            sha256=self.pkg.sha256,
+            digest=pushes[0].get("digest") if pushes else None,
+            tags=[x["uri"].rsplit(":", 1)[-1] for x in pushes],
+            status=status,
+        )
+
 
 class DownloadTask(TaskBase):
     """
@@ -173,17 +280,307 @@ class TaskRunner:
 
         # Keep track of results
         items = []
-        with mp.Pool(processes=self.workers) as pool:
-            for result in pool.map(run_task, self.tasks):
-                # This is a smaller list of packages/repo metadata pushes
-                if isinstance(result, list):
-                    items += result
-                else:
-                    items.append(result)
+
+        # Registry tokens are shared between workers (and this process)
+        with mp.Manager() as manager:
+            tokens = manager.dict(oras.tokens)
+            oras.tokens = tokens
+            with mp.Pool(
+                processes=self.workers, initializer=init_worker, initargs=(tokens,)
+            ) as pool:
+                for result in pool.imap(run_task, self.dispatch()):
+                    # This is a smaller list of packages/repo metadata pushes
+                    if isinstance(result, list):
+                        items += result
+                    else:
+                        items.append(result)
+            oras.tokens = dict(tokens)
 
         # Return all results from running the task
         return items
 
+    def dispatch(self):
+        """
+        Yield tasks to the pool, getting tokens for each window of them first.
+        """
+        for i, task in enumerate(self.tasks):
+            if i % defaults.token_prefetch_window == 0:
+                self.prefetch_tokens(i)
+            yield task
+
+    def prefetch_tokens(self, start):
+        """
+        Request registry tokens for the repositories of a window of tasks.
+        """
+        tasks = self.tasks[start : start + defaults.token_prefetch_window]
+        repositories = [t.repository for t in tasks if getattr(t, "repository", None)]
+        if not repositories:
+            return
+        try:
+            oras.prefetch_tokens(repositories)
+        except Exception as e:
+            logger.debug(f"Cannot prefetch registry tokens: {e}")
+
+
+class StagedBytes:
+    """
+    A budget of bytes for packages staged on disk.
+
+    Acquiring waits until enough staged packages are released. A package
+    larger than the whole budget goes through when nothing else is staged.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            self.condition.wait_for(
+                lambda: not self.used or self.used + size <= self.max_bytes
+            )
+            self.used += size
+        return size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class PipelineRunner(TaskRunner):
+    """
+    Run package upload tasks through a pipeline of stages.
+
+    Packages are downloaded, have their metadata prepared (cpu bound), and
+    are pushed by separate workers joined by bounded queues, so the network
+    and cpu are busy at once and throughput is that of the slowest stage.
+    Downloads and pushes are threads (each pushing thread has its own
+    client and session), and metadata is prepared in a process pool. Tasks
+    start as soon as they are added, and downloads wait while too many
+    bytes are staged. Other tasks (e.g., repodata uploads) are run by the
+    process pool after all packages, except for subdirs with a package
+    that failed.
+    """
+
+    def __init__(
+        self,
+        workers=1,
+        download_workers=None,
+        metadata_workers=None,
+        upload_workers=None,
+        queue_size=None,
+        max_staged_bytes=None,
+    ):
+        super().__init__(workers)
+        self.download_workers = download_workers or workers
+        self.metadata_workers = (
+            metadata_workers
+            or defaults.pipeline_metadata_workers
+            or min(workers, os.cpu_count() or 1)
+        )
+        self.upload_workers = upload_workers or workers
+        queue_size = queue_size or defaults.pipeline_queue_size
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(3)]
+        self.staged = StagedBytes(
+            max_staged_bytes or defaults.pipeline_max_staged_bytes
+        )
+
+        # Worker threads for each stage, and what they give back
+        self.stages = []
+        self.items = []
+        self.errors = []
+        self.lock = threading.Lock()
+
+        # Processes to prepare metadata, and a client for each pushing thread
+        self.executor = None
+        self.local = threading.local()
+
+        # The (channel, subdir) of packages that failed
+        self.failed = set()
+
+        # Repositories of added tasks to get registry tokens for
+        self.repositories = []
+
+    def add_task(self, task):
+        """
+        Add a task, starting it now if it is a package upload.
+        """
+        if not isinstance(task, PackageUploadTask):
+            return super().add_task(task)
+        self.start()
+        if task.repository:
+            self.repositories.append(task.repository)
+        if len(self.repositories) >= defaults.token_prefetch_window:
+            self.prefetch_repositories()
+        self.queues[0].put((task, 0))
+
+    def start(self):
+        """
+        Start the workers for each stage (if they are not running).
+        """
+        if self.stages:
+            return
+
+        global counter_start
+        with counter_start.get_lock():
+            counter_start.value = time.time()
+
+        # Downloads share the connection pool (pushes have their own)
+        sessions.ensure_pool_size(self.download_workers)
+
+        # Processes are spawned, since forking with threads running is unsafe
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.metadata_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=init_prepare_worker,
+            initargs=(pkg.metadata_cache,),
+        )
+        for index, (stage, count) in enumerate(
+            [
+                (self.download, self.download_workers),
+                (self.prepare, self.metadata_workers),
+                (self.push, self.upload_workers),
+            ]
+        ):
+            threads = [
+                threading.Thread(target=self.work, args=(index, stage), daemon=True)
+                for _ in range(count)
+            ]
+            for thread in threads:
+                thread.start()
+            self.stages.append(threads)
+
+    def work(self, index, stage):
+        """
+        Run a stage for tasks from its queue, and pass them to the next.
+        """
+        while True:
+            item = self.queues[index].get()
+            if item is None:
+                return
+            task, size = item
+            try:
+                size = stage(task, size)
+            except Exception as e:
+                logger.error(f"Cannot push {task.pkg.filename}: {e}")
+                task.cleanup(delete=False)
+                self.staged.release(size)
+                with self.lock:
+                    self.errors.append(e)
+                    self.failed.add((task.pkg.channel, task.pkg.subdir))
+                continue
+            if index + 1 < len(self.queues):
+                self.queues[index + 1].put((task, size))
+
+    def download(self, task, size):
+        """
+        Download a package, once there is room to stage it.
+        """
+        size = self.staged.acquire(task.size)
+        try:
+            task.download()
+        except Exception:
+            self.staged.release(size)
+            raise
+        return size
+
+    def prepare(self, task, size):
+        task.prepare(self.executor)
+        return size
+
+    def push(self, task, size):
+        """
+        Push a package, and delete it to make room for the next.
+        """
+        if not hasattr(self.local, "client"):
+            self.local.client = oras.clone()
+        result = task.push(self.local.client)
+        task.cleanup()
+        self.staged.release(size)
+        with self.lock:
+            if isinstance(result, list):
+                self.items += result
+            else:
+                self.items.append(result)
+        return 0
+
+    def run(self):
+        """
+        Wait for package tasks to finish, then run the rest.
+        """
+        self.prefetch_repositories()
+
+        # Each stage is finished when the one before it is
+        for index, threads in enumerate(self.stages):
+            for _ in threads:
+                self.queues[index].put(None)
+            for thread in threads:
+                thread.join()
+        self.stages = []
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+        # We don't push repodata for a subdir with packages that failed
+        for task in self.tasks:
+            repo = getattr(task, "repo", None)
+            if repo and (repo.channel, repo.subdir) in self.failed:
+                logger.warning(
+                    f"Not pushing repodata for {repo.channel}/{repo.subdir}, packages failed."
+                )
+        self.tasks = [
+            task
+            for task in self.tasks
+            if not getattr(task, "repo", None)
+            or (task.repo.channel, task.repo.subdir) not in self.failed
+        ]
+
+        items = self.items
+        self.items = []
+        if self.tasks:
+            items += super().run()
+
+        # The first failure is raised once everything else is pushed
+        if self.errors:
+            raise self.errors[0]
+        return items
+
+    def prefetch_repositories(self):
+        """
+        Request registry tokens for the repositories of tasks we added.
+        """
+        repositories, self.repositories = self.repositories, []
+        if not repositories:
+            return
+        try:
+            oras.prefetch_tokens(repositories)
+        except Exception as e:
+            logger.debug(f"Cannot prefetch registry tokens: {e}")
+
+
+def init_prepare_worker(metadata_cache):
+    """
+    Share the package metadata cache with processes preparing metadata.
+    """
+    pkg.metadata_cache = metadata_cache
+
+
+def prepare_upload(package, staging_dir):
+    """
+    Prepare the layers of a package, giving back its digests too.
+    """
+    pusher = package.prepare_upload(staging_dir)
+    return pusher, package.digests
+
+
+def init_worker(tokens):
+    """
+    Share registry tokens between worker processes.
+    """
+    oras.tokens = tokens
+
 
 def run_task(t):
     """
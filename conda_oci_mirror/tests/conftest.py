@@ -1,3 +1,4 @@
+import json
 import os
 import sys
 
@@ -5,6 +6,7 @@ import pytest
 from xprocess import ProcessStarter
 
 import conda_oci_mirror.defaults as defaults
+import conda_oci_mirror.jlap as jlap
 from conda_oci_mirror.mirror import Mirror
 
 # The setup.cfg doesn't install the main module proper
@@ -34,6 +36,17 @@ def check_media_type(layer):
         raise ValueError(f"Unexpected layer content type {layer}")
 
 
+def make_jlap(lines, iv=b"\0" * 32):
+    """
+    Write JLAP content for lines, with the iv first and the checksum last.
+    """
+    lines = [json.dumps(line).encode("utf-8") for line in lines]
+    checksum = iv
+    for line in lines:
+        checksum = jlap.keyed_hash(line, checksum)
+    return b"\n".join([iv.hex().encode("utf-8")] + lines + [checksum.hex().encode()])
+
+
 def registry_host():
     return os.environ.get("registry_host") or "http://127.0.0.1"
 
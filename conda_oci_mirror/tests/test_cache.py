@@ -0,0 +1,38 @@
+#!/usr/bin/python
+
+import os
+
+from conda_oci_mirror.cache import DiskCache
+
+
+def test_disk_cache_evict(tmp_path):
+    """
+    Eviction removes the least recently used entries, but not partial writes.
+    """
+    cache = DiskCache(tmp_path / "cache", max_bytes=1)
+    cache.save("a", {"value": "a"})
+    cache.save("b", {"value": "b"})
+
+    # Another writer has an entry in flight
+    tmp = f"{cache.path('c')}.1234.5678.tmp"
+    os.makedirs(os.path.dirname(tmp), exist_ok=True)
+    with open(tmp, "w") as fd:
+        fd.write("{")
+
+    cache.evict()
+    assert cache.load("a") is None and cache.load("b") is None
+    assert os.path.exists(tmp)
+
+
+def test_disk_cache_load_evicted(tmp_path, monkeypatch):
+    """
+    An entry evicted between reading and touching it is still returned.
+    """
+    cache = DiskCache(tmp_path / "cache", max_bytes=1024)
+    cache.save("a", {"value": "a"})
+
+    def utime(path):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(os, "utime", utime)
+    assert cache.load("a") == {"value": "a"}
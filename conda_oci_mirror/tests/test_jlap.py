@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+import json
+
+import pytest
+from conftest import make_jlap
+
+import conda_oci_mirror.jlap as jlap
+
+
+def test_jlap_patches():
+    """
+    Patches are verified, chained from the hash we have, and applied.
+    """
+    repodata = {"packages": {"a-1-0.tar.bz2": {"name": "a"}}, "packages.conda": {}}
+    patches = [
+        {
+            "from": "h0",
+            "to": "h1",
+            "patch": [
+                {"op": "add", "path": "/packages.conda/b-1-0.conda", "value": {}},
+                {"op": "replace", "path": "/packages/a-1-0.tar.bz2/name", "value": "A"},
+            ],
+        },
+        {
+            "from": "h1",
+            "to": "h2",
+            "patch": [{"op": "remove", "path": "/packages/a-1-0.tar.bz2"}],
+        },
+    ]
+    content = make_jlap(patches + [{"url": "repodata.json", "latest": "h2"}])
+    found, metadata, pos, iv = jlap.parse(content)
+    assert found == patches
+    assert content[pos:].startswith(b'{"url"')
+
+    # Reading on from the metadata line verifies with the iv we saved
+    assert jlap.parse(content[pos:], iv)[1] == metadata
+
+    # We only need the patches since the repodata we have
+    assert jlap.find_patches(found, "h1", metadata["latest"]) == patches[1:]
+    with pytest.raises(jlap.JlapError):
+        jlap.find_patches(found, "unknown", metadata["latest"])
+
+    for patch in jlap.find_patches(found, "h0", metadata["latest"]):
+        repodata = jlap.apply_patch(repodata, patch["patch"])
+    assert repodata == {"packages": {}, "packages.conda": {"b-1-0.conda": {}}}
+    assert jlap.changed_filenames(patches) == ({"b-1-0.conda"}, {"a-1-0.tar.bz2"})
+
+    # A changed line breaks the checksum chain
+    with pytest.raises(jlap.JlapError):
+        jlap.parse(content.replace(b"h2", b"h3"))
+
+
+def test_patch_repodata(tmp_path):
+    """
+    Patches applied as the repodata streams match patches applied in memory.
+    """
+    repodata = {
+        "info": {"subdir": "noarch"},
+        "packages": {
+            "a-1-0.tar.bz2": {"name": "a", "depends": ["python"]},
+            "c-1-0.tar.bz2": {"name": "c", "depends": []},
+        },
+        "packages.conda": {},
+        "repodata_version": 1,
+    }
+    patches = [
+        {
+            "from": "h0",
+            "to": "h1",
+            "patch": [
+                {"op": "add", "path": "/packages.conda/b-1-0.conda", "value": {}},
+                {
+                    "op": "add",
+                    "path": "/packages/a-1-0.tar.bz2/depends/-",
+                    "value": "z",
+                },
+                {"op": "remove", "path": "/packages/c-1-0.tar.bz2"},
+                {"op": "add", "path": "/removed", "value": ["c-1-0.tar.bz2"]},
+            ],
+        },
+        {
+            "from": "h1",
+            "to": "h2",
+            "patch": [
+                {"op": "replace", "path": "/info/subdir", "value": "linux-64"},
+                {
+                    "op": "add",
+                    "path": "/packages/d-1-0.tar.bz2",
+                    "value": {"name": "d"},
+                },
+            ],
+        },
+    ]
+    source = tmp_path / "repodata.json"
+    dest = tmp_path / "repodata.json.partial"
+    source.write_text(json.dumps(repodata))
+    jlap.patch_repodata(source, dest, patches)
+
+    for patch in patches:
+        repodata = jlap.apply_patch(repodata, patch["patch"])
+    assert json.loads(dest.read_text()) == repodata
+
+    # A move between records can't be streamed
+    move = [{"op": "move", "from": "/packages/a-1-0.tar.bz2", "path": "/packages/e"}]
+    with pytest.raises(jlap.JlapError):
+        jlap.patch_repodata(source, dest, [{"patch": move}])
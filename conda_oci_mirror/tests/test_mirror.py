@@ -134,3 +134,29 @@ def test_mirror(subdir, num_updates, package_name, mirror_instance):
             assert "info.tar.gz" in os.listdir(fullpath)
             fullpath = os.path.join(pull_dir, result, "info")
             assert "index.json" in os.listdir(fullpath)
+
+
+@pytest.mark.parametrize(
+    "subdir,num_updates,package_name",
+    [("noarch", 6, "redo")],
+)
+def test_mirror_pipeline(subdir, num_updates, package_name, mirror_instance):
+    """
+    Test a mirror that is not serial (packages are pushed through the pipeline)
+    """
+    m = mirror_instance
+    updates = m.update()
+    assert len(updates) == num_updates
+    for update in updates:
+        for layer in update["layers"]:
+            check_media_type(layer)
+
+    # Packages and the repodata were pushed
+    expected_repo = f"{m.registry}/{m.channel}/{subdir}/{package_name}"
+    assert oras.get_tags(expected_repo)
+    expected_latest = f"{m.registry}/{m.channel}/{subdir}/repodata.json:latest"
+    assert "latest" in oras.get_tags(expected_latest)
+
+    # The packages were deleted after they were pushed
+    cache_subdir = os.path.join(m.cache_dir, m.channel, subdir)
+    assert not [x for x in os.listdir(cache_subdir) if x.endswith((".conda", ".bz2"))]
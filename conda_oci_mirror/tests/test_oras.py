@@ -0,0 +1,517 @@
+#!/usr/bin/python
+
+import base64
+import hashlib
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import jsonschema
+import pytest
+
+import conda_oci_mirror.defaults as defaults
+import conda_oci_mirror.sessions as sessions
+from conda_oci_mirror.oras import Registry, add_known_blob
+
+
+class BasicAuthHandler(http.server.BaseHTTPRequestHandler):
+    """
+    A registry that only answers requests with basic auth.
+    """
+
+    credentials = base64.b64encode(b"dinosaur:password").decode("utf-8")
+    refused = 0
+
+    def do_HEAD(self):
+        if self.headers.get("Authorization") != f"Basic {self.credentials}":
+            BasicAuthHandler.refused += 1
+            self.send_response(401)
+            self.send_header("Www-Authenticate", 'Basic realm="Registry Realm"')
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def basic_auth_registry():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), BasicAuthHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_basic_auth_in_threads(basic_auth_registry):
+    """
+    Requests from worker threads carry the basic auth of the client.
+    """
+    BasicAuthHandler.refused = 0
+    client = Registry(insecure=True)
+    client.set_basic_auth("dinosaur", "password")
+    container = client.get_container(f"{basic_auth_registry}/dinosaur/zlib:1.2.13-0")
+    digest = f"sha256:{'0' * 64}"
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        response = executor.submit(client.get_blob, container, digest, head=True)
+        assert response.result().status_code == 200
+
+    # The first request from the thread had the credentials
+    assert BasicAuthHandler.refused == 0
+
+    # Without basic auth the registry refuses the request
+    client = Registry(insecure=True)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        response = executor.submit(client.get_blob, container, digest, head=True)
+        assert response.result().status_code == 401
+
+
+class ManifestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    A registry that answers with a manifest that isn't valid.
+    """
+
+    def do_GET(self):
+        content = json.dumps({"schemaVersion": "two"}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.oci.image.manifest.v1+json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_cached_manifest_validated(tmp_path):
+    """
+    A manifest from the registry is validated before it is cached.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ManifestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        client = Registry(insecure=True)
+        client.set_cache_dir(str(tmp_path))
+        uri = f"127.0.0.1:{server.server_address[1]}/dinosaur/zlib:1.2.13-0"
+        with pytest.raises(jsonschema.ValidationError):
+            client.get_cached_manifest(uri)
+        assert client.manifest_cache.get(uri) is None
+    finally:
+        server.shutdown()
+
+
+class BearerHandler(http.server.BaseHTTPRequestHandler):
+    """
+    A registry that asks for a bearer token (per repository) for blobs.
+    """
+
+    protocol_version = "HTTP/1.1"
+    content = b"dinosaur"
+
+    def send(self, status, content=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        # The token is only good for the repository it was asked for
+        if self.path.startswith("/token"):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            token = json.dumps({"token": query["scope"][0]}).encode("utf-8")
+            return self.send(200, token)
+
+        repository = self.path.split("/v2/", 1)[1].split("/blobs/")[0]
+        scope = f"repository:{repository}:pull"
+        if self.headers.get("Authorization") == f"Bearer {scope}":
+            return self.send(200, self.content)
+        host, port = self.server.server_address
+        challenge = (
+            f'Bearer realm="http://{host}:{port}/token",service="test",'
+            f'scope="{scope}"'
+        )
+        self.send(401, b"{}", {"Www-Authenticate": challenge})
+
+    def log_message(self, *args):
+        pass
+
+
+def test_bearer_challenges_release_connections(tmp_path, monkeypatch):
+    """
+    A streamed request that is answered with a challenge doesn't hold its
+    connection, so many of them don't use up the pool.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), BearerHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(sessions, "pool_size", sessions.pool_size)
+    monkeypatch.setattr(sessions, "session", None)
+    sessions.set_pool_size(2)
+
+    client = Registry(insecure=True)
+    digest = f"sha256:{hashlib.sha256(BearerHandler.content).hexdigest()}"
+    layer = {"digest": digest, "size": len(BearerHandler.content)}
+    downloaded = []
+
+    def download():
+        for i in range(5):
+            uri = f"127.0.0.1:{server.server_address[1]}/dinosaur/pkg{i}:1.0-0"
+            container = client.get_container(uri)
+            path = str(tmp_path / f"pkg{i}")
+            downloaded.append(client.download_verified_blob(container, layer, path))
+
+    # A leaked connection blocks the next request forever, so don't wait on it
+    worker = threading.Thread(target=download, daemon=True)
+    worker.start()
+    worker.join(timeout=30)
+    server.shutdown()
+    assert not worker.is_alive() and len(downloaded) == 5
+
+
+class TagsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    A registry that lists tags in pages (n), after a cursor (last).
+    """
+
+    protocol_version = "HTTP/1.1"
+    tags = []
+    ignore_last = False
+    queries = []
+
+    def do_GET(self):
+        parts = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        TagsHandler.queries.append(query)
+
+        tags = sorted(self.tags)
+        if query.get("last") and not self.ignore_last:
+            tags = [x for x in tags if x > query["last"]]
+        n = int(query.get("n", 1000))
+        page = tags[:n]
+
+        content = json.dumps({"name": "dinosaur/zlib", "tags": page}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if len(tags) > n:
+            link = f"{parts.path}?n={n}&last={page[-1]}"
+            self.send_header("Link", f'<{link}>; rel="next"')
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def tags_registry():
+    TagsHandler.tags = []
+    TagsHandler.ignore_last = False
+    TagsHandler.queries = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), TagsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"127.0.0.1:{server.server_address[1]}/dinosaur/zlib"
+    server.shutdown()
+
+
+def test_list_tags_pages(tags_registry, monkeypatch):
+    """
+    Tags are listed following the Link to each page, optionally after a cursor.
+    """
+    monkeypatch.setattr(defaults, "tag_snapshot_page_size", 2)
+    TagsHandler.tags = [f"1.{i}-0" for i in range(5)]
+    client = Registry(insecure=True)
+
+    assert client.list_tags(tags_registry) == TagsHandler.tags
+    assert [x.get("last") for x in TagsHandler.queries] == [None, "1.1-0", "1.3-0"]
+    assert client.list_tags(tags_registry, last="1.2-0") == ["1.3-0", "1.4-0"]
+
+
+def test_cached_tags(tags_registry, tmp_path, monkeypatch):
+    """
+    Tags after the cursor are merged into the snapshot, and a full listing
+    reconciles it once it is too old.
+    """
+    TagsHandler.tags = ["1.0-0", "2.0-0"]
+    client = Registry(insecure=True)
+    client.set_cache_dir(str(tmp_path))
+    assert client.get_cached_tags(tags_registry) == ["1.0-0", "2.0-0"]
+
+    # A tag is pushed after the cursor, one before it, and one is deleted
+    TagsHandler.tags = ["0.5-0", "2.0-0", "3.0-0"]
+    TagsHandler.queries = []
+    assert client.get_cached_tags(tags_registry) == ["1.0-0", "2.0-0", "3.0-0"]
+    assert TagsHandler.queries[0]["last"] == "2.0-0"
+
+    # Tags we push are added as we go
+    client.add_snapshot_tag(client.get_container(f"{tags_registry}:4.0-0"))
+    assert "4.0-0" in client.get_cached_tags(tags_registry)
+
+    # An expired snapshot is listed again in full
+    TagsHandler.queries = []
+    monkeypatch.setattr(defaults, "tag_snapshot_max_age", 0)
+    assert client.get_cached_tags(tags_registry) == ["0.5-0", "2.0-0", "3.0-0"]
+    assert "last" not in TagsHandler.queries[0]
+
+
+def test_cached_tags_cursor_ignored(tags_registry, tmp_path):
+    """
+    A registry that ignores the cursor lists it again, so we list all tags.
+    """
+    TagsHandler.tags = ["1.0-0", "2.0-0"]
+    client = Registry(insecure=True)
+    client.set_cache_dir(str(tmp_path))
+    client.get_cached_tags(tags_registry)
+
+    TagsHandler.ignore_last = True
+    TagsHandler.tags = ["0.5-0", "2.0-0"]
+    TagsHandler.queries = []
+    assert client.get_cached_tags(tags_registry) == ["0.5-0", "2.0-0"]
+    assert len(TagsHandler.queries) == 2 and "last" not in TagsHandler.queries[1]
+
+
+class UploadHandler(http.server.BaseHTTPRequestHandler):
+    """
+    A registry that takes blobs whole (PUT) or in chunks (PATCH), or mounts them.
+
+    A chunk that starts at an offset in fail_chunks fails once, after the
+    registry kept half of it, and refuse_chunks refuses every PATCH. Blobs
+    are kept by (repository, digest).
+    """
+
+    protocol_version = "HTTP/1.1"
+    blobs = {}
+    uploads = {}
+    fail_chunks = set()
+    refuse_chunks = False
+    refuse_mount = False
+    requests = []
+
+    @property
+    def repository(self):
+        return self.path[len("/v2/") : self.path.index("/blobs/")]
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def respond(self, status, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def upload_headers(self, session):
+        headers = {"Location": self.path.split("?")[0]}
+        if self.uploads[session]:
+            headers["Range"] = f"0-{len(self.uploads[session]) - 1}"
+        return headers
+
+    def do_HEAD(self):
+        UploadHandler.requests.append(("HEAD", self.path))
+        digest = self.path.rsplit("/", 1)[-1]
+        self.respond(200 if (self.repository, digest) in self.blobs else 404)
+
+    def do_POST(self):
+        self.read_body()
+        UploadHandler.requests.append(("POST", self.path))
+        parts = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        source = (query.get("from"), query.get("mount"))
+        if source in self.blobs and not self.refuse_mount:
+            self.blobs[(self.repository, source[1])] = self.blobs[source]
+            return self.respond(201)
+
+        # Otherwise (as with a refused mount) an upload session is started
+        session = str(len(self.uploads))
+        self.uploads[session] = b""
+        path = parts.path
+        self.respond(202, {"Location": f"{path}{session}"})
+
+    def do_PATCH(self):
+        data = self.read_body()
+        UploadHandler.requests.append(("PATCH", self.path))
+        session = self.path.rsplit("/", 1)[-1]
+        start = int(self.headers["Content-Range"].split("-")[0])
+        if self.refuse_chunks:
+            return self.respond(405)
+        if start != len(self.uploads[session]):
+            return self.respond(416)
+        if start in self.fail_chunks:
+            self.fail_chunks.remove(start)
+            self.uploads[session] += data[: len(data) // 2]
+            return self.respond(500)
+        self.uploads[session] += data
+        self.respond(202, self.upload_headers(session))
+
+    def do_GET(self):
+        UploadHandler.requests.append(("GET", self.path))
+        session = self.path.rsplit("/", 1)[-1]
+        self.respond(204, self.upload_headers(session))
+
+    def do_PUT(self):
+        data = self.read_body()
+        UploadHandler.requests.append(("PUT", self.path))
+        parts = urllib.parse.urlparse(self.path)
+        session = parts.path.rsplit("/", 1)[-1]
+        digest = dict(urllib.parse.parse_qsl(parts.query))["digest"]
+        blob = self.uploads.pop(session) + data
+        if digest != f"sha256:{hashlib.sha256(blob).hexdigest()}":
+            return self.respond(400)
+        self.blobs[(self.repository, digest)] = blob
+        self.respond(201)
+
+    def do_DELETE(self):
+        UploadHandler.requests.append(("DELETE", self.path))
+        self.uploads.pop(self.path.rsplit("/", 1)[-1], None)
+        self.respond(204)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upload_registry(monkeypatch):
+    UploadHandler.blobs = {}
+    UploadHandler.uploads = {}
+    UploadHandler.fail_chunks = set()
+    UploadHandler.refuse_chunks = False
+    UploadHandler.refuse_mount = False
+    UploadHandler.requests = []
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    monkeypatch.setattr("conda_oci_mirror.oras.blob_cache", {})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), UploadHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"127.0.0.1:{server.server_address[1]}/dinosaur/zlib"
+    server.shutdown()
+
+
+def write_blob(path, size):
+    """
+    Write a blob and return the layer for it.
+    """
+    data = bytes(i % 251 for i in range(size))
+    path.write_bytes(data)
+    return {"digest": f"sha256:{hashlib.sha256(data).hexdigest()}", "size": size}
+
+
+def test_resumable_upload(upload_registry, tmp_path, monkeypatch):
+    """
+    A failed chunk is resumed from the offset the registry has, and each chunk
+    gets its own attempts.
+    """
+    monkeypatch.setattr(defaults, "chunked_upload_size", 100)
+    monkeypatch.setattr(defaults, "chunked_upload_attempts", 1)
+    UploadHandler.fail_chunks = {100, 250}
+    layer = write_blob(tmp_path / "blob", 350)
+    client = Registry(insecure=True)
+    container = client.get_container(f"{upload_registry}:1.2.13-0")
+
+    response = client.resumable_upload(str(tmp_path / "blob"), container, layer)
+    assert response.status_code == 201
+    blob = UploadHandler.blobs[("dinosaur/zlib", layer["digest"])]
+    assert blob == (tmp_path / "blob").read_bytes()
+
+    # Each failed chunk asked for the offset, and continued from it
+    methods = [x[0] for x in UploadHandler.requests]
+    assert methods.count("GET") == 2
+    assert methods.count("PATCH") == 5
+
+
+def test_resumable_upload_refused(upload_registry, tmp_path, monkeypatch):
+    """
+    A registry that refuses chunks gets the blob whole, and the session is cancelled.
+    """
+    monkeypatch.setattr(defaults, "chunked_upload_size", 100)
+    UploadHandler.refuse_chunks = True
+    layer = write_blob(tmp_path / "blob", 350)
+    client = Registry(insecure=True)
+    container = client.get_container(f"{upload_registry}:1.2.13-0")
+
+    response = client.resumable_upload(str(tmp_path / "blob"), container, layer)
+    assert response.status_code == 201
+    blob = UploadHandler.blobs[("dinosaur/zlib", layer["digest"])]
+    assert blob == (tmp_path / "blob").read_bytes()
+    methods = [x[0] for x in UploadHandler.requests]
+    assert methods == ["POST", "PATCH", "DELETE", "POST", "PUT"]
+    assert not UploadHandler.uploads
+
+
+def test_upload_offset(upload_registry):
+    """
+    The Range of an upload is inclusive, so 0-0 means one byte was received.
+    """
+    UploadHandler.uploads = {"0": b"", "1": b"x"}
+    client = Registry(insecure=True)
+    container = client.get_container(f"{upload_registry}:1.2.13-0")
+    session_url = (
+        f"http://{upload_registry.split('/')[0]}/v2/dinosaur/zlib/blobs/uploads/"
+    )
+
+    assert client.get_upload_offset(f"{session_url}0", container)[1] == 0
+    assert client.get_upload_offset(f"{session_url}1", container)[1] == 1
+
+
+def test_ensure_blob_exists(upload_registry, tmp_path):
+    """
+    A blob the repository has is not uploaded, and is remembered.
+    """
+    layer = write_blob(tmp_path / "blob", 100)
+    UploadHandler.blobs[("dinosaur/zlib", layer["digest"])] = b""
+    client = Registry(insecure=True)
+    container = client.get_container(f"{upload_registry}:1.2.13-0")
+
+    assert not client.ensure_blob(str(tmp_path / "blob"), container, layer)
+    assert [x[0] for x in UploadHandler.requests] == ["HEAD"]
+
+    # The second time we don't need to ask
+    assert not client.ensure_blob(str(tmp_path / "blob"), container, layer)
+    assert len(UploadHandler.requests) == 1
+
+
+def test_mount_blob(upload_registry, tmp_path):
+    """
+    A blob we know is in another repository is mounted instead of uploaded.
+    """
+    layer = write_blob(tmp_path / "blob", 100)
+    UploadHandler.blobs[("dinosaur/openssl", layer["digest"])] = b"openssl"
+    registry = upload_registry.split("/")[0]
+    add_known_blob(layer["digest"], f"{registry}/dinosaur/openssl")
+    client = Registry(insecure=True)
+    container = client.get_container(f"{upload_registry}:1.2.13-0")
+
+    assert not client.ensure_blob(str(tmp_path / "blob"), container, layer)
+    assert [x[0] for x in UploadHandler.requests] == ["HEAD", "POST"]
+    assert UploadHandler.blobs[("dinosaur/zlib", layer["digest"])] == b"openssl"
+    assert not UploadHandler.uploads
+
+
+def test_mount_blob_refused(upload_registry, tmp_path):
+    """
+    A refused mount cancels the session the registry started, then uploads.
+    """
+    UploadHandler.refuse_mount = True
+    layer = write_blob(tmp_path / "blob", 100)
+    UploadHandler.blobs[("dinosaur/openssl", layer["digest"])] = b"openssl"
+    registry = upload_registry.split("/")[0]
+    add_known_blob(layer["digest"], f"{registry}/dinosaur/openssl")
+    client = Registry(insecure=True)
+    container = client.get_container(f"{upload_registry}:1.2.13-0")
+
+    assert client.ensure_blob(str(tmp_path / "blob"), container, layer)
+    methods = [x[0] for x in UploadHandler.requests]
+    assert methods == ["HEAD", "POST", "DELETE", "POST", "PUT"]
+    blob = UploadHandler.blobs[("dinosaur/zlib", layer["digest"])]
+    assert blob == (tmp_path / "blob").read_bytes()
+    assert not UploadHandler.uploads
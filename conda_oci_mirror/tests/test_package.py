@@ -1,4 +1,28 @@
-from conda_oci_mirror.package import Package, _download_file_once
+import bz2
+import io
+import json
+import os
+import tarfile
+import zipfile
+
+import pytest
+import zstandard as zstd
+
+import conda_oci_mirror.package as package
+from conda_oci_mirror.package import Package, _download_file_once, write_info
+
+
+def make_tar(files):
+    """
+    Make a tar archive (bytes) with files of (name, content)
+    """
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w") as tar:
+        for name, content in files:
+            member = tarfile.TarInfo(name)
+            member.size = len(content)
+            tar.addfile(member, io.BytesIO(content))
+    return out.getvalue()
 
 
 def test_package_download_fallback(tmp_path, monkeypatch):
@@ -24,3 +48,88 @@ def test_package_download_fallback(tmp_path, monkeypatch):
         "ghcr.io/channel-mirrors",
     )
     package.ensure_file()
+
+
+@pytest.mark.parametrize("ext", [".tar.bz2", ".conda"])
+def test_write_info(tmp_path, ext):
+    """
+    info.tar.gz and info/index.json are written straight from the archive.
+    """
+    index = json.dumps({"name": "tiny", "subdir": "noarch"}).encode("utf-8")
+    info = [("info/index.json", index), ("info/recipe/meta.yaml", b"x: 1")]
+    pkg = [("lib/tiny.txt", b"tiny")]
+
+    path = os.path.join(tmp_path, f"tiny-1.0-0{ext}")
+    if ext == ".conda":
+        with zipfile.ZipFile(path, "w") as archive:
+            archive.writestr("metadata.json", '{"conda_pkg_format_version": 2}')
+            compress = zstd.ZstdCompressor().compress
+            archive.writestr("pkg-tiny-1.0-0.tar.zst", compress(make_tar(pkg)))
+            archive.writestr("info-tiny-1.0-0.tar.zst", compress(make_tar(info)))
+    else:
+        with open(path, "wb") as fd:
+            fd.write(bz2.compress(make_tar(info + pkg)))
+
+    dest_dir = os.path.join(tmp_path, "staging")
+    write_info(path, dest_dir)
+    with open(os.path.join(dest_dir, "info", "index.json"), "rb") as fd:
+        assert fd.read() == index
+
+    # Entries are named relative to info/, and nothing else is included
+    with tarfile.open(os.path.join(dest_dir, "info.tar.gz")) as tar:
+        assert tar.getnames() == ["index.json", "recipe/meta.yaml"]
+        assert tar.extractfile("recipe/meta.yaml").read() == b"x: 1"
+
+
+def test_write_info_interleaved(tmp_path):
+    """
+    A .tar.bz2 with info/ entries between other files has all of its info.
+    """
+    index = json.dumps({"name": "tiny", "subdir": "noarch"}).encode("utf-8")
+    files = [
+        ("info/about.json", b"{}"),
+        ("lib/tiny.txt", b"tiny"),
+        ("info/index.json", index),
+        ("lib/other.txt", b"other"),
+        ("info/recipe/meta.yaml", b"x: 1"),
+    ]
+    path = os.path.join(tmp_path, "tiny-1.0-0.tar.bz2")
+    with open(path, "wb") as fd:
+        fd.write(bz2.compress(make_tar(files)))
+
+    dest_dir = os.path.join(tmp_path, "staging")
+    write_info(path, dest_dir)
+    with open(os.path.join(dest_dir, "info", "index.json"), "rb") as fd:
+        assert fd.read() == index
+    with tarfile.open(os.path.join(dest_dir, "info.tar.gz")) as tar:
+        assert tar.getnames() == ["about.json", "index.json", "recipe/meta.yaml"]
+
+
+def test_metadata_cache(tmp_path, monkeypatch):
+    """
+    Info metadata for an archive we have seen is written from the cache.
+    """
+    index = json.dumps({"name": "tiny", "subdir": "noarch"}).encode("utf-8")
+    path = os.path.join(tmp_path, "tiny-1.0-0.tar.bz2")
+    with open(path, "wb") as fd:
+        fd.write(bz2.compress(make_tar([("info/index.json", index)])))
+
+    monkeypatch.setattr(package, "metadata_cache", None)
+    package.set_cache_dir(os.path.join(tmp_path, "cache"))
+    pkg = Package("conda-forge", "noarch", path, tmp_path, "ghcr.io/channel-mirrors")
+    pkg.file = path
+    layers = pkg.prepare_metadata(os.path.join(tmp_path, "first"))
+
+    # The archive isn't read again (even by another package with the file)
+    with monkeypatch.context() as m:
+        m.setattr(package, "write_info", None)
+        pkg = Package("conda-forge", "noarch", path, tmp_path, "ghcr.io/other")
+        pkg.file = path
+        assert pkg.prepare_metadata(os.path.join(tmp_path, "second")) == layers
+
+    for name in package.info_files:
+        with open(os.path.join(tmp_path, "first", "tiny-1.0-0", name), "rb") as fd:
+            first = fd.read()
+        with open(os.path.join(tmp_path, "second", "tiny-1.0-0", name), "rb") as fd:
+            assert fd.read() == first
+        assert layers[name]["size"] == len(first)
@@ -1,12 +1,18 @@
 #!/usr/bin/python
 
+import bz2
+import gzip
+import json
 import os
 import sys
 import tarfile
 from pathlib import Path
 
 import pytest
+import zstandard as zstd
+from conftest import make_jlap
 
+import conda_oci_mirror.repo as repository
 from conda_oci_mirror.logger import setup_logger
 from conda_oci_mirror.repo import PackageRepo, RepoData
 
@@ -31,6 +37,241 @@ class TestRepoData:
     def test_get_latest_tag(self, repo_data):
         assert repo_data.get_latest_tag("pytest") == "7.2.0-py310hbbe02a8_1"
 
+    def test_index(self, repo_data):
+        packages = list(repo_data.packages)
+        assert repo_data.package_archives == set(x[0] for x in packages)
+        assert repo_data.package_names == set(x[1]["name"] for x in packages)
+        subset = [x for x in packages if x[1]["name"] == "pytest"]
+        assert list(repo_data.filtered_packages("pytest")) == subset
+
+    def test_compact_records(self, repo_data):
+        full = json.loads((Path(__file__).parent / "test_repodata.json").read_text())
+        for package_type in repo_data.package_types:
+            for package_file, info in full[package_type].items():
+                record = repo_data.data[package_type][package_file]
+                assert record.to_dict() == {
+                    k: v for k, v in info.items() if k in record.__slots__
+                }
+                assert "depends" not in record
+
+
+def test_existing_tags(monkeypatch):
+    """
+    Existing tags are reversed (and cached) from the first call.
+    """
+    calls = []
+
+    def get_cached_tags(container):
+        calls.append(container)
+        return ["1.0__p__local-0"]
+
+    monkeypatch.setattr(repository, "existing_tags_cache", repository.TagsCache())
+    monkeypatch.setattr(repository.oras, "get_cached_tags", get_cached_tags)
+    repo = PackageRepo("conda-forge", "noarch", None, registry="localhost:5000")
+    assert repo.get_existing_tags("zlib") == ["1.0+local-0"]
+    assert repo.get_existing_tags("zlib") == ["1.0+local-0"]
+    assert list(repo.iter_existing_tags(["zlib"])) == [("zlib", ["1.0+local-0"])]
+    assert calls == ["localhost:5000/conda-forge/noarch/zlib"]
+
+
+def test_fetched_repodata(tmp_path, monkeypatch):
+    """
+    Repodata is fetched once per run (a shared memo), and again in a new run.
+    """
+    calls = []
+    monkeypatch.setattr(
+        PackageRepo, "download_repodata", lambda self, url, path: calls.append(url)
+    )
+    monkeypatch.setattr(PackageRepo, "update_repodata", lambda self, url, path: None)
+
+    fetched = {}
+    for _ in range(2):
+        repo = PackageRepo(
+            "conda-forge",
+            "noarch",
+            tmp_path,
+            registry="localhost:5000",
+            fetched=fetched,
+        )
+        repo.ensure_repodata()
+    assert len(calls) == 2
+
+    # A new run (e.g., a second Mirror.update) fetches again
+    PackageRepo(
+        "conda-forge", "noarch", tmp_path, registry="localhost:5000"
+    ).ensure_repodata()
+    assert len(calls) == 4
+
+
+class FakeResponse:
+    """
+    A streamed response with some content.
+    """
+
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {"ETag": '"abc"'}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+
+class FakeSession:
+    """
+    A session with responses by file name (anything else is not found).
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requested = []
+
+    def get(self, url, **kwargs):
+        self.requested.append(os.path.basename(url))
+        return self.responses.get(os.path.basename(url), FakeResponse(b"", 404))
+
+
+def test_download_truncated_repodata(tmp_path, monkeypatch):
+    """
+    A truncated compressed download falls back to the next variant.
+    """
+    content = json.dumps({"packages": {}, "packages.conda": {}}).encode("utf-8")
+    compressed = zstd.ZstdCompressor().compress(content)
+    responses = {
+        "repodata.json.zst": FakeResponse(compressed[:-4]),
+        "repodata.json.bz2": FakeResponse(b"", 404),
+        "repodata.json": FakeResponse(content),
+    }
+    session = FakeSession(responses)
+    monkeypatch.setattr(repository.sessions, "get_session", lambda: session)
+    repo = PackageRepo("conda-forge", "noarch", tmp_path, registry="localhost:5000")
+    assert repo.download_repodata("https://example.com/repodata.json", repo.repodata)
+
+    assert session.requested == [
+        "repodata.json.zst",
+        "repodata.json.bz2",
+        "repodata.json",
+    ]
+    assert Path(repo.repodata).read_bytes() == content
+    assert not os.path.exists(f"{repo.repodata}.partial")
+    state = json.loads(Path(repo.get_state_file(repo.repodata)).read_text())
+    assert state["url"].endswith("repodata.json")
+
+    # The whole stream is used as is
+    responses["repodata.json.zst"] = FakeResponse(compressed)
+    os.remove(repo.get_state_file(repo.repodata))
+    assert repo.download_repodata("https://example.com/repodata.json", repo.repodata)
+    assert Path(repo.repodata).read_bytes() == content
+
+
+def write_cached_repodata(repo, repodata, state):
+    """
+    Write cached repodata and its download state.
+    """
+    Path(repo.repodata).write_text(json.dumps(repodata))
+    Path(repo.get_state_file(repo.repodata)).write_text(json.dumps(state))
+
+
+def test_update_repodata_since_sync(tmp_path, monkeypatch):
+    """
+    Packages added are counted from the repodata we last pushed.
+    """
+    patches = [
+        {
+            "from": "h0",
+            "to": "h1",
+            "patch": [{"op": "add", "path": "/packages/b-1-0.tar.bz2", "value": {}}],
+        },
+        {
+            "from": "h1",
+            "to": "h2",
+            "patch": [{"op": "add", "path": "/packages/c-1-0.tar.bz2", "value": {}}],
+        },
+    ]
+    content = make_jlap(patches + [{"url": "repodata.json", "latest": "h2"}])
+    session = FakeSession({"repodata.jlap": FakeResponse(content)})
+    monkeypatch.setattr(repository.sessions, "get_session", lambda: session)
+
+    # We have h1 (b is added), but the last push was h0 (b may not be pushed)
+    repo = PackageRepo("conda-forge", "noarch", tmp_path, registry="localhost:5000")
+    repodata = {"packages": {"b-1-0.tar.bz2": {}}, "packages.conda": {}}
+    state = {"blake2b": "h1", "synced": {"blake2b": "h0", "jlap": None}}
+    write_cached_repodata(repo, repodata, state)
+
+    url = "https://example.com/repodata.jlap"
+    added = {"b-1-0.tar.bz2", "c-1-0.tar.bz2"}
+    assert repo.update_repodata(url, repo.repodata) == (added, set())
+    assert set(json.loads(Path(repo.repodata).read_text())["packages"]) == added
+
+    # Without a push, the changes are still counted from h0
+    assert repo.update_repodata(url, repo.repodata) == (added, set())
+
+    # Once pushed, there is nothing new
+    repo.mark_synced()
+    assert repo.update_repodata(url, repo.repodata) == (set(), set())
+
+    # A cached copy that isn't what we wrote isn't patched
+    Path(repo.repodata).write_text(json.dumps(repodata))
+    assert repo.update_repodata(url, repo.repodata) is None
+
+
+def test_find_changed_packages(tmp_path, monkeypatch):
+    """
+    Packages added are looked for in repodata.json, the file they come from.
+    """
+    repo = PackageRepo("conda-forge", "noarch", tmp_path, registry="localhost:5000")
+    record = {"name": "a", "version": "1", "build": "0", "build_number": 0}
+    packages = {"a-1-0.tar.bz2": record, "a-2-0.tar.bz2": dict(record, version="2")}
+    Path(repo.repodata).write_text(json.dumps({"packages": packages}))
+    Path(repo.patches).write_text(json.dumps({"packages": {}}))
+    repo.fetched[repo.repodata] = ({"a-2-0.tar.bz2"}, set())
+    monkeypatch.setattr(PackageRepo, "get_mirrored_archives", lambda *args: set())
+
+    found = repo.find_packages(changed_only=True, shallow=True)
+    assert [pkg for pkg, _ in found] == ["a-2-0.tar.bz2"]
+
+
+@pytest.mark.parametrize("have,corrupt", [("h0", True), ("unknown", False)])
+def test_update_repodata_fallback(tmp_path, monkeypatch, have, corrupt):
+    """
+    A corrupt JLAP file or a patch chain that doesn't lead from the repodata
+    we have falls back to a full download.
+    """
+    patches = [
+        {
+            "from": "h0",
+            "to": "h1",
+            "patch": [{"op": "add", "path": "/packages/b-1-0.tar.bz2", "value": {}}],
+        }
+    ]
+    content = make_jlap(patches + [{"url": "repodata.json", "latest": "h1"}])
+    if corrupt:
+        content = content.replace(b"b-1-0", b"c-1-0")
+    fresh = json.dumps({"packages": {"d-1-0.tar.bz2": {}}}).encode("utf-8")
+    session = FakeSession(
+        {
+            "repodata.jlap": FakeResponse(content),
+            "repodata.json": FakeResponse(fresh),
+            "repodata_from_packages.json": FakeResponse(fresh),
+        }
+    )
+    monkeypatch.setattr(repository.sessions, "get_session", lambda: session)
+
+    repo = PackageRepo("conda-forge", "noarch", tmp_path, registry="localhost:5000")
+    write_cached_repodata(repo, {"packages": {}}, {"blake2b": have})
+    repo.ensure_repodata()
+
+    assert "repodata.json" in session.requested
+    assert Path(repo.repodata).read_bytes() == fresh
+    assert repo.added_packages is None
+
 
 def test_package_repo(mirror_instance):
     """
@@ -107,3 +348,43 @@ def test_package_repo(mirror_instance):
         # Find the layer with the media type
         layer = [x for x in result["layers"] if "conda.package" in x["media_type"]][0]
         assert os.path.basename(layer["path"]) == os.path.basename(pkg)
+
+
+def test_compress_repodata(tmp_path):
+    """
+    Repodata is compressed to zstd and each variant, which decompress to it.
+    """
+    repo = PackageRepo("conda-forge", "noarch", tmp_path, registry="localhost:5000")
+    content = json.dumps({"packages": {}, "packages.conda": {}}).encode("utf-8")
+    Path(repo.repodata).write_bytes(content)
+
+    paths = repo.compress_repodata(["bz2", "gz"])
+    assert list(paths) == ["zst", "bz2", "gz"]
+    with open(paths["zst"], "rb") as fd:
+        assert zstd.ZstdDecompressor().stream_reader(fd).read() == content
+    assert bz2.decompress(Path(paths["bz2"]).read_bytes()) == content
+    assert gzip.decompress(Path(paths["gz"]).read_bytes()) == content
+
+    # Every variant has a media type to push it with
+    assert set(paths) <= set(repository.repodata_compressions)
+
+
+def test_mirrored_archives(tmp_path, monkeypatch):
+    """
+    Only files the pushed repodata lists as packages count as mirrored.
+    """
+    pushed = {
+        "packages": {"a-1-0.tar.bz2": {"name": "a", "version": "1", "build": "0"}},
+        "packages.conda": {"b-1-0.conda": {"name": "b", "version": "1", "build": "0"}},
+        "removed": ["c-1-0.tar.bz2"],
+    }
+
+    def pull_by_media_type(uri, dest, media_type):
+        path = os.path.join(dest, "repodata.json")
+        with open(path, "w") as fd:
+            json.dump(pushed, fd)
+        return [path]
+
+    monkeypatch.setattr(repository.oras, "pull_by_media_type", pull_by_media_type)
+    repo = PackageRepo("conda-forge", "noarch", tmp_path, registry="localhost:5000")
+    assert repo.get_mirrored_archives() == {"a-1-0.tar.bz2", "b-1-0.conda"}
@@ -0,0 +1,30 @@
+#!/usr/bin/python
+
+import threading
+import time
+
+import conda_oci_mirror.sessions as sessions
+
+
+def test_iter_concurrent():
+    """
+    Results come back for each item, with at most concurrency in flight.
+    """
+    running = {"now": 0, "max": 0}
+    lock = threading.Lock()
+
+    def square(x):
+        with lock:
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        time.sleep(0.01)
+        with lock:
+            running["now"] -= 1
+        if x == 3:
+            raise ValueError("three")
+        return x * x
+
+    results = dict(sessions.iter_concurrent(square, range(10), concurrency=2))
+    assert isinstance(results.pop(3), ValueError)
+    assert results == {x: x * x for x in range(10) if x != 3}
+    assert running["max"] <= 2
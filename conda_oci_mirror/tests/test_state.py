@@ -0,0 +1,42 @@
+#!/usr/bin/python
+
+import os
+
+import conda_oci_mirror.state as sync_state
+
+
+def test_sync_state(tmp_path):
+    """
+    The sync state keeps what we pushed between runs.
+    """
+    path = os.path.join(tmp_path, "state.db")
+    state = sync_state.SyncState(path)
+    state.record(
+        "ghcr.io/mirror",
+        "conda-forge",
+        "noarch",
+        "zlib-1.2.11-0.tar.bz2",
+        sha256="abc",
+        digest="sha256:123",
+        tags=["1.2.11-0"],
+    )
+    state.record(
+        "ghcr.io/mirror",
+        "conda-forge",
+        "noarch",
+        "zlib-1.2.12-0.tar.bz2",
+        status=sync_state.FAILED,
+    )
+
+    # A new run opens the same database
+    known = sync_state.SyncState(path).get_subdir(
+        "ghcr.io/mirror", "conda-forge", "noarch"
+    )
+    assert known["zlib-1.2.11-0.tar.bz2"]["digest"] == "sha256:123"
+    assert known["zlib-1.2.11-0.tar.bz2"]["tags"] == ["1.2.11-0"]
+    assert sync_state.is_mirrored(known["zlib-1.2.11-0.tar.bz2"], "abc")
+
+    # A failed push, or a different upstream file, needs to be checked again
+    assert not sync_state.is_mirrored(known["zlib-1.2.11-0.tar.bz2"], "def")
+    assert not sync_state.is_mirrored(known["zlib-1.2.12-0.tar.bz2"])
+    assert not state.get("ghcr.io/other", "conda-forge", "noarch", "zlib")
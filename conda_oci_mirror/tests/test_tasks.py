@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+import threading
+import time
+import types
+
+import pytest
+
+import conda_oci_mirror.oras as oras_module
+import conda_oci_mirror.tasks as tasks
+
+# Bytes of fake packages downloaded (and not deleted), now and at most
+staged = {"now": 0, "max": 0}
+staged_lock = threading.Lock()
+
+
+class FakePackage:
+    """
+    A package that takes a little time to download, prepare and push.
+
+    Metadata is prepared in another process, so the package is pickled.
+    """
+
+    registry = "ghcr.io/channel-mirrors"
+    repository = None
+    channel = "conda-forge"
+
+    def __init__(self, name, size, subdir="noarch", fail=False):
+        self.filename = name
+        self.subdir = subdir
+        self.package_info = {"size": size}
+        self.file = None
+        self.digests = None
+        self.fail = fail
+
+    def ensure_file(self):
+        time.sleep(0.01)
+        self.file = self.filename
+        with staged_lock:
+            staged["now"] += self.package_info["size"]
+            staged["max"] = max(staged["max"], staged["now"])
+
+    def prepare_upload(self, staging_dir):
+        if self.fail:
+            raise ValueError(f"{self.filename} is corrupt")
+        self.digests = {"sha256": self.filename}
+        return types.SimpleNamespace(root=staging_dir)
+
+    def push(self, pusher, dry_run=False):
+        time.sleep(0.01)
+        return [{"uri": f"{self.registry}/{self.filename}:1.0-0"}]
+
+    def delete(self):
+        with staged_lock:
+            staged["now"] -= self.package_info["size"]
+
+
+class ClientCheckPackage(FakePackage):
+    """
+    A package that notes if the process preparing it created an oras client.
+    """
+
+    def prepare_upload(self, staging_dir):
+        self.digests = {"client": oras_module.oras._client is not None}
+        return types.SimpleNamespace(root=staging_dir)
+
+
+class FakeRepoTask:
+    """
+    A repodata upload task for a subdir.
+    """
+
+    def __init__(self, subdir):
+        self.repo = FakePackage("repodata.json", 0, subdir)
+
+    def run(self):
+        return {"uri": f"{self.repo.subdir}/repodata.json:latest"}
+
+
+@pytest.fixture(autouse=True)
+def reset_staged():
+    staged.update({"now": 0, "max": 0})
+
+
+def test_pipeline_runner():
+    """
+    Packages go through every stage, with staged bytes under the budget.
+    """
+    runner = tasks.PipelineRunner(
+        workers=4, metadata_workers=2, queue_size=2, max_staged_bytes=300
+    )
+    for i in range(20):
+        pkg = FakePackage(f"pkg{i}", 100)
+        runner.add_task(tasks.PackageUploadTask(pkg, wait_time=0))
+
+    items = runner.run()
+    assert sorted(x["uri"] for x in items) == sorted(
+        f"{FakePackage.registry}/pkg{i}:1.0-0" for i in range(20)
+    )
+    assert staged["max"] <= 300
+    assert staged["now"] == 0 and runner.staged.used == 0
+
+
+def test_pipeline_runner_failure():
+    """
+    A package that fails is kept, and the error raised once the rest finish.
+
+    Repodata is only pushed for subdirs without a package that failed.
+    """
+    runner = tasks.PipelineRunner(workers=2, metadata_workers=1, max_staged_bytes=200)
+    for i in range(5):
+        subdir = "linux-64" if i == 2 else "noarch"
+        pkg = FakePackage(f"pkg{i}", 100, subdir, fail=i == 2)
+        runner.add_task(tasks.PackageUploadTask(pkg, wait_time=0))
+    for subdir in ["noarch", "linux-64"]:
+        runner.add_task(FakeRepoTask(subdir))
+
+    with pytest.raises(ValueError):
+        runner.run()
+    assert [x.repo.subdir for x in runner.tasks] == ["noarch"]
+    assert staged["now"] == 100 and runner.staged.used == 0
+
+
+def test_pipeline_runner_metadata_workers():
+    """
+    Processes preparing metadata don't create a client, and are capped at the workers.
+    """
+    assert tasks.PipelineRunner(workers=1).metadata_workers == 1
+
+    runner = tasks.PipelineRunner(workers=2, metadata_workers=1)
+    task = tasks.PackageUploadTask(ClientCheckPackage("pkg0", 100), wait_time=0)
+    runner.add_task(task)
+    runner.run()
+    assert task.pkg.digests == {"client": False}
+
+
+def test_task_runner_dispatch(monkeypatch):
+    """
+    Tokens for a window of tasks are requested before the window is dispatched.
+    """
+    monkeypatch.setattr(tasks.defaults, "token_prefetch_window", 2)
+    runner = tasks.TaskRunner(workers=2)
+    for i in range(5):
+        runner.add_task(types.SimpleNamespace(repository=f"channel/noarch/pkg{i}"))
+
+    events = []
+    monkeypatch.setattr(runner, "prefetch_tokens", lambda i: events.append(i))
+    for task in runner.dispatch():
+        events.append(task.repository)
+    assert events == [
+        0,
+        "channel/noarch/pkg0",
+        "channel/noarch/pkg1",
+        2,
+        "channel/noarch/pkg2",
+        "channel/noarch/pkg3",
+        4,
+        "channel/noarch/pkg4",
+    ]
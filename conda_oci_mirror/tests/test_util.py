@@ -0,0 +1,25 @@
+#!/usr/bin/python
+
+import os
+
+import conda_oci_mirror.util as util
+
+
+def test_cached_sha256sum(tmp_path, monkeypatch):
+    """
+    The sha256 is cached next to the file until the file changes.
+    """
+    path = os.path.join(tmp_path, "repodata.json")
+    util.write_file("{}", path)
+    digest = util.cached_sha256sum(path)
+    assert digest == util.sha256sum(path)
+    assert os.path.exists(util.digest_sidecar(path))
+
+    # An unchanged file is not hashed again
+    with monkeypatch.context() as m:
+        m.setattr(util, "sha256sum", lambda path: "not-hashed-again")
+        assert util.cached_sha256sum(path) == digest
+
+    # But a changed file is
+    util.write_file('{"packages": {}}', path)
+    assert util.cached_sha256sum(path) == util.sha256sum(path) != digest
@@ -0,0 +1,35 @@
+#!/usr/bin/python
+
+import random
+
+import conda_oci_mirror.versions as versions
+
+
+def test_sort_versions():
+    """
+    Versions sort in conda's order, and odd versions sort lowest.
+    """
+    expected = [
+        "not!a.version",
+        "0.4.1.rc",
+        "0.4.1",
+        "0.5a1",
+        "0.5",
+        "1.0",
+        "1.0.post1",
+        "1.0.1",
+        "1.1dev1",
+        "1.1a1",
+        "1.1rc1",
+        "1.1",
+        "1.1_1",
+        "1.9",
+        "1.10",
+        "1!0.1",
+    ]
+    shuffled = list(expected)
+    random.shuffle(shuffled)
+    assert versions.sort_versions(shuffled) == expected
+    assert versions.latest_version(shuffled) == "1!0.1"
+    assert versions.newest_versions(shuffled, 2) == ["1!0.1", "1.10"]
+    assert versions.latest_version([]) is None
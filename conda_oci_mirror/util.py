@@ -2,10 +2,7 @@ import errno
 import hashlib
 import json
 import os
-import platform
-import subprocess
 import sys
-import tarfile
 
 
 def print_item(prefix, item):
@@ -62,24 +59,6 @@ def mkdir_p(path):
             sys.exit(f"Error creating path {path}, exiting.")
 
 
-def compress_folder(source_dir, output_filename):
-    """
-    Compress a directory to an output destination
-    """
-    if not platform.system() == "Windows":
-        return subprocess.run(
-            f"tar -cvzf {output_filename} *",
-            cwd=source_dir,
-            shell=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            check=True,
-        )
-    else:
-        with tarfile.open(output_filename, "w:gz") as tar:
-            tar.add(source_dir, arcname=".")
-
-
 def sha256sum(path):
     hash_func = hashlib.sha256()
 
@@ -98,3 +77,63 @@ def md5sum(fn):
             curr_sha.update(byte_block)
 
     return curr_sha.hexdigest()
+
+
+def file_digests(path, chunk_size=1024 * 1024):
+    """
+    Get the sha256, md5 and size of a file in one read.
+    """
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    size = 0
+    with open(path, "rb") as f:
+        for byte_block in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(byte_block)
+            md5.update(byte_block)
+            size += len(byte_block)
+    return {"sha256": sha256.hexdigest(), "md5": md5.hexdigest(), "size": size}
+
+
+def digest_sidecar(path):
+    """
+    Get the path of the sidecar file that caches the sha256 of a file.
+    """
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, f".{basename}.sha256")
+
+
+def write_digest_sidecar(path, digest):
+    """
+    Record the sha256 of a file, keyed by its inode, size, and mtime.
+    """
+    st = os.stat(path)
+    meta = {
+        "inode": st.st_ino,
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+        "sha256": digest,
+    }
+    return write_json(meta, digest_sidecar(path))
+
+
+def cached_sha256sum(path):
+    """
+    Get the sha256 of a file, only hashing it again if it has changed.
+    """
+    st = os.stat(path)
+    sidecar = digest_sidecar(path)
+    if os.path.exists(sidecar):
+        try:
+            meta = read_json(sidecar)
+        except ValueError:
+            meta = {}
+        if (
+            meta.get("inode") == st.st_ino
+            and meta.get("size") == st.st_size
+            and meta.get("mtime") == st.st_mtime_ns
+        ):
+            return meta["sha256"]
+
+    digest = sha256sum(path)
+    write_digest_sidecar(path, digest)
+    return digest
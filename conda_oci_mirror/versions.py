@@ -0,0 +1,140 @@
+# Ordering of conda versions (as conda's VersionOrder) for sorting many at once
+
+import functools
+import re
+
+# A version component is split into runs of digits and of other characters
+atom_regex = re.compile(r"\d+|[^\d]+")
+
+# Atoms sort by kind first: dev < other strings (e.g., rc) < numbers < post
+DEV, STRING, NUMBER, POST = range(4)
+
+# Shorter versions and components are padded with zero (1.1 == 1.1.0)
+zero = (NUMBER, 0)
+
+
+def parse_atom(atom):
+    """
+    Parse an atom into its kind and value (flattened into a component).
+    """
+    if atom.isdigit():
+        return (NUMBER, int(atom))
+    if atom == "dev":
+        return (DEV, atom)
+    if atom == "post":
+        return (POST, 0)
+    return (STRING, atom)
+
+
+def parse_components(version):
+    """
+    Parse a version (without epoch or local part) into components.
+
+    Each component is a flat tuple of (kind, value) pairs for its atoms, so
+    that keys are flat tuples that compare quickly.
+    """
+    components = []
+    for part in version.replace("-", ".").replace("_", ".").split("."):
+        if not part:
+            continue
+
+        # Most components are a plain number
+        if part.isdigit():
+            components.append((NUMBER, int(part)))
+            continue
+        atoms = atom_regex.findall(part)
+
+        # A component starting with a string is a pre-release of zero (1.a)
+        if not atoms[0].isdigit():
+            atoms.insert(0, "0")
+        components.append(sum((parse_atom(atom) for atom in atoms), ()))
+    return tuple(components)
+
+
+@functools.lru_cache(maxsize=None)
+def parse_version(version):
+    """
+    Parse a conda version into (version, local) components, None if invalid.
+
+    The epoch (e.g., the 1 in 1!2.0) is the first version component.
+    """
+    if not isinstance(version, str):
+        return
+    version = version.strip().lower()
+
+    epoch = "0"
+    if "!" in version:
+        epoch, version = version.split("!", 1)
+        if not epoch.isdigit():
+            return
+
+    local = ""
+    if "+" in version:
+        version, local = version.split("+", 1)
+
+    components = parse_components(version)
+    if not components:
+        return
+    return (((NUMBER, int(epoch)),) + components, parse_components(local))
+
+
+def pad(components, length, width):
+    """
+    Pad components (of width atoms) to length, flattened into one tuple.
+    """
+    key = ()
+    for component in components:
+        key += component + zero * (width - len(component) // 2)
+    return key + zero * (width * (length - len(components)))
+
+
+def sort_keys(versions):
+    """
+    Get sort keys for versions that compare in conda's order.
+
+    Versions are padded to the longest version (and component) in the set,
+    so keys only compare with keys from the same call. Invalid versions
+    sort lowest instead of raising.
+    """
+    parsed = [parse_version(v) for v in versions]
+    valid = [p for p in parsed if p]
+    if not valid:
+        return [(0,) for _ in parsed]
+
+    length = max(len(p[0]) for p in valid)
+    local_length = max(len(p[1]) for p in valid)
+    width = max(len(c) // 2 for p in valid for c in p[0] + p[1])
+
+    keys = []
+    for p in parsed:
+        if not p:
+            keys.append((0,))
+            continue
+        keys.append((1,) + pad(p[0], length, width) + pad(p[1], local_length, width))
+    return keys
+
+
+def sort_versions(versions, reverse=False):
+    """
+    Sort versions in conda's order (oldest first unless reverse).
+    """
+    versions = list(versions)
+    keys = sort_keys(versions)
+    order = sorted(range(len(versions)), key=keys.__getitem__, reverse=reverse)
+    return [versions[i] for i in order]
+
+
+def newest_versions(versions, count=1):
+    """
+    Get the newest count versions, newest first.
+    """
+    return sort_versions(versions, reverse=True)[:count]
+
+
+def latest_version(versions):
+    """
+    Get the latest of some versions, or None if there are none.
+    """
+    newest = newest_versions(versions)
+    if newest:
+        return newest[0]